@@ -0,0 +1,110 @@
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import torch
+import torch.nn.functional as F
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main_scripts'))
+from mil_model import Attention_Gated, BACKBONES
+
+
+def saved_bytes(fn):
+    # Bytes of distinct tensors kept for backward, i.e. the activation memory
+    # that checkpointing trades for recomputation (device independent).
+    seen = {}
+    def pack(t):
+        seen[(t.device, t.untyped_storage().data_ptr())] = t.untyped_storage().nbytes()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, sum(seen.values())
+
+
+def step(model, x, y):
+    model.zero_grad(set_to_none=True)
+    torch.manual_seed(0)
+    out, saved = saved_bytes(lambda: F.binary_cross_entropy(model(x), y))
+    out.backward()
+    return saved
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(model, x, y, repeat, device):
+    # Peak is the CUDA allocator's high-water mark, or on CPU the growth of
+    # the process's peak RSS over its size before the first step.
+    if device.type == 'cpu':
+        base = rss()
+    step(model, x, y)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        saved = step(model, x, y)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeat
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base) / 2**20
+    grads = torch.cat([p.grad.reshape(-1) for p in model.parameters() if p.grad is not None])
+    return elapsed, saved / 2**20, peak, grads
+
+
+def measure_forked(model, x, y, repeat, device):
+    # On CPU every configuration runs in a fresh fork, so the peak RSS of
+    # one does not hide that of the next.
+    if device.type != 'cpu':
+        return measure(model, x, y, repeat, device)
+    ctx = multiprocessing.get_context('fork')
+    recv, send = ctx.Pipe(duplex=False)
+    def child():
+        elapsed, saved, peak, grads = measure(model, x, y, repeat, device)
+        send.send((elapsed, saved, peak, grads.numpy()))
+    proc = ctx.Process(target=child)
+    proc.start()
+    elapsed, saved, peak, grads = recv.recv()
+    proc.join()
+    return elapsed, saved, peak, torch.from_numpy(grads)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Training step time and activation memory of Attention_Gated with and without activation checkpointing')
+    parser.add_argument('--model', default='inceptionv3', choices=sorted(BACKBONES))
+    parser.add_argument('--padding', default='4,8,16', type=str, help='comma separated clusters per bag')
+    parser.add_argument('--segments', default='2,4,8', type=str, help='comma separated checkpoint segment counts')
+    parser.add_argument('--extd', default=7, type=int)
+    parser.add_argument('--size', default=224, type=int, help='training tile size')
+    parser.add_argument('--repeat', default=2, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = Attention_Gated(args.model, pretrain=False, extd=args.extd).to(device).train()
+    modes = [(0, False)] + [(s, False) for s in map(int, args.segments.split(','))] + [(int(args.segments.split(',')[-1]), True)]
+    print('Device:', device, 'model:', args.model)
+    print('{:>7} {:>6} {:>8} {:>8} {:>10} {:>10} {:>10} {:>9}'.format(
+        'padding', 'tiles', 'segments', 'encoder', 'step(s)', 'saved(MB)', 'peak(MB)', 'max|dg|'))
+    for padding in map(int, args.padding.split(',')):
+        n = padding * (args.extd + 1)
+        x = torch.randn(n, 3, args.size, args.size, device=device)
+        y = torch.ones(1, 1, device=device)
+        ref = None
+        for segments, encoder in modes:
+            model.checkpoint_segments, model.checkpoint_encoder = segments, encoder
+            elapsed, saved, peak, grads = measure_forked(model, x, y, args.repeat, device)
+            ref = grads if ref is None else ref
+            print('{:>7} {:>6} {:>8} {:>8} {:>10.3f} {:>10.1f} {:>10.1f} {:>9.2e}'.format(
+                padding, n, segments or 'off', 'yes' if encoder else 'no', elapsed, saved, peak, (grads - ref).abs().max().item()))
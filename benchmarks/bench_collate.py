@@ -0,0 +1,54 @@
+from __future__ import print_function
+import numpy as np
+import argparse
+import os
+import sys
+import time
+import torch
+from PIL import Image
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main_scripts'))
+from bag_loader import collate_tiles, PinnedRing
+
+
+def legacy_collate(imgs):
+    # fast_collate before the pinned ring: zero-fill, rollaxis copy, add.
+    w, h = imgs[0].size[0], imgs[0].size[1]
+    tensor = torch.zeros((len(imgs), 3, h, w), dtype=torch.uint8)
+    for i, img in enumerate(imgs):
+        numpy_array = np.asarray(img, dtype=np.uint8)
+        numpy_array = np.rollaxis(numpy_array, 2)
+        tensor[i] += torch.from_numpy(numpy_array.copy())
+    return tensor
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return (time.perf_counter() - start) / repeat, out
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Per-bag fast_collate time, legacy vs ring buffer')
+    parser.add_argument('--tiles', default='32,400', type=str, help='comma separated bag sizes (clusters x (extd+1))')
+    parser.add_argument('--size', default=299, type=int)
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    rng = np.random.default_rng(args.seed)
+    pin = torch.cuda.is_available()
+    print('Pinned buffers:', pin)
+    print('{:>6} {:>12} {:>12} {:>12} {:>8} {:>6}'.format('tiles', 'legacy(ms)', 'fresh(ms)', 'ring(ms)', 'speedup', 'equal'))
+    for n in map(int, args.tiles.split(',')):
+        imgs = [Image.fromarray(rng.integers(0, 256, (args.size, args.size, 3), dtype=np.uint8)) for _ in range(n)]
+        ring = PinnedRing(pin=pin)
+        t_old, ref = timeit(lambda: legacy_collate(imgs), args.repeat)
+        t_new, _ = timeit(lambda: collate_tiles(imgs), args.repeat)
+        t_ring, out = timeit(lambda: collate_tiles(imgs, ring=ring), args.repeat)
+        print('{:>6} {:>12.2f} {:>12.2f} {:>12.2f} {:>7.1f}x {:>6}'.format(
+            n, t_old*1e3, t_new*1e3, t_ring*1e3, t_old / t_ring, str(torch.equal(ref, out.contiguous()))))
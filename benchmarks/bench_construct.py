@@ -0,0 +1,47 @@
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+import warnings
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main_scripts'))
+from mil_model import Attention_Gated, BACKBONES, profile_backbone
+
+
+def timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return (time.perf_counter() - start) / repeat, out
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Attention_Gated construction time per backbone: initialized vs lazy (checkpoint to be loaded), and backbone profiling')
+    parser.add_argument('--models', default=','.join(BACKBONES), type=str, help='comma separated backbone names')
+    parser.add_argument('--extd', default=7, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--profile', action='store_true', help='also time the thop profile, first and cached call (needs thop)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    warnings.filterwarnings('ignore')
+    torch.manual_seed(0)
+    print('{:>14} {:>12} {:>10} {:>8} {:>9} {:>12} {:>11}'.format(
+        'model', 'init(ms)', 'lazy(ms)', 'speedup', 'max|dY|', 'profile(s)', 'cached(us)'))
+    x = torch.randn(2*(args.extd+1), 3, 224, 224)
+    for name in args.models.split(','):
+        t_init, ref = timeit(lambda: Attention_Gated(name, pretrain=False, extd=args.extd), args.repeat)
+        t_lazy, lazy = timeit(lambda: Attention_Gated(name, pretrain=False, extd=args.extd, lazy=True), args.repeat)
+        # A lazy model is only usable once its checkpoint is loaded.
+        lazy.load_state_dict(ref.state_dict())
+        with torch.no_grad():
+            diff = (ref.eval()(x) - lazy.eval()(x)).abs().max().item()
+        t_prof = t_cached = float('nan')
+        if args.profile:
+            t_prof, _ = timeit(lambda: profile_backbone(name), 1)
+            t_cached, _ = timeit(lambda: profile_backbone(name), 1)
+        print('{:>14} {:>12.1f} {:>10.1f} {:>7.1f}x {:>9.2e} {:>12.2f} {:>11.1f}'.format(
+            name, t_init*1e3, t_lazy*1e3, t_init / t_lazy, diff, t_prof, t_cached*1e6))
@@ -0,0 +1,90 @@
+from __future__ import print_function
+import numpy as np
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+from PIL import Image, ImageFilter
+from torchvision import transforms
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main_scripts'))
+from tile_io import DraftDecode
+
+
+PIPELINES = {
+    # MILTest / MILTrain validation
+    'eval': (transforms.Compose([transforms.CenterCrop(384), transforms.Resize(299)]), True),
+    # MILHotmap / CAM
+    'cam': (transforms.Compose([transforms.Resize(299)]), True),
+    # MILTrain training, without the colour jitter
+    'train': (transforms.Compose([transforms.RandomCrop(384), transforms.Resize(299),
+                                  transforms.RandomResizedCrop(224, scale=(0.4, 1.0)),
+                                  transforms.RandomHorizontalFlip()]), False),
+}
+
+
+def make_tiles(n, size, rng):
+    # Smoothed noise compresses to roughly the size of real H&E tiles.
+    tiles = []
+    for _ in range(n):
+        img = Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+        buf = io.BytesIO()
+        img.filter(ImageFilter.GaussianBlur(2)).save(buf, format='JPEG', quality=90)
+        tiles.append(buf.getvalue())
+    return tiles
+
+
+def load_tiles(src, n):
+    tiles = []
+    for p in sorted(glob.glob(os.path.join(src, '**', '*.jpg'), recursive=True))[:n]:
+        with open(p, 'rb') as f:
+            tiles.append(f.read())
+    return tiles
+
+
+def run(tiles, transform, repeat):
+    best = 0.
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = [np.asarray(transform(Image.open(io.BytesIO(t)))) for t in tiles]
+        best = max(best, len(tiles) / (time.perf_counter() - start))
+    return best, out
+
+
+def psnr(ref, out):
+    mse = np.mean([np.mean((a.astype(np.float64) - b) ** 2) for a, b in zip(ref, out)])
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Per-core JPEG decode + transform throughput and parity with draft decoding')
+    parser.add_argument('--src', default=None, type=str, help='directory of real .jpg tiles (default: synthetic tiles)')
+    parser.add_argument('--tiles', default=200, type=int)
+    parser.add_argument('--size', default=512, type=int)
+    parser.add_argument('--tolerance', default='1.0,1.2,1.6,3.2', type=str, help='comma separated draft tolerances')
+    parser.add_argument('--repeat', default=3, type=int, help='best of this many passes')
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    rng = np.random.default_rng(args.seed)
+    tiles = load_tiles(args.src, args.tiles) if args.src else make_tiles(args.tiles, args.size, rng)
+    size = Image.open(io.BytesIO(tiles[0])).size
+    print('Tiles:', len(tiles), 'of', size)
+    print('{:>6} {:>9} {:>7} {:>10} {:>8} {:>9} {:>8}'.format('', 'tolerance', 'scale', 'tiles/s', 'speedup', 'PSNR(dB)', 'max|d|'))
+    for name, (transform, deterministic) in PIPELINES.items():
+        base, ref = run(tiles, transform, args.repeat)
+        print('{:>6} {:>9} {:>7} {:>10.1f} {:>7.2f}x {:>9} {:>8}'.format(name, 'off', '1', base, 1., '-', '-'))
+        for tolerance in map(float, args.tolerance.split(',')):
+            draft = DraftDecode(transform, tolerance)
+            rate, out = run(tiles, draft, args.repeat)
+            scale = '1/{:g}'.format(1. / draft.scale(size))
+            if deterministic:
+                diff = max(int(np.abs(a.astype(np.int16) - b).max()) for a, b in zip(ref, out))
+                quality = '{:>9.2f} {:>8}'.format(psnr(ref, out), diff)
+            else:
+                quality = '{:>9} {:>8}'.format('-', '-')
+            print('{:>6} {:>9g} {:>7} {:>10.1f} {:>7.2f}x {}'.format('', tolerance, scale, rate, rate / base, quality))
@@ -0,0 +1,66 @@
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main_scripts'))
+from mil_ops import attention_pool
+
+
+def loop_pool(H, inner_attention):
+    # Attention_Gated.forward before batching: one softmax + mm per cluster.
+    return torch.cat([torch.mm(F.softmax(inner_attention(h).transpose(0,1), dim=1), h) for h in H], 0)
+
+
+def batched_pool(H, inner_attention):
+    return attention_pool(H, inner_attention(H))
+
+
+def timeit(fn, repeat, device, backward=False):
+    def step():
+        out = fn()
+        if backward:
+            out.sum().backward()
+        return out
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat, out
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Inner (intra-cluster) attention pooling, per-cluster loop vs batched')
+    parser.add_argument('--clusters', default='4,50,500,5000', type=str, help='comma separated cluster counts')
+    parser.add_argument('--extd', default=7, type=int)
+    parser.add_argument('--L', default=512, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    inner_attention = nn.Linear(args.L, 1).to(device)
+    nn.init.xavier_normal_(inner_attention.weight)
+    print('Device:', device)
+    print('{:>8} {:>11} {:>11} {:>8} {:>14} {:>14} {:>8} {:>9}'.format(
+        'clusters', 'loop(ms)', 'batch(ms)', 'speedup', 'loop+bw(ms)', 'batch+bw(ms)', 'speedup', 'max|d|'))
+    for n in map(int, args.clusters.split(',')):
+        H = torch.randn(n, args.extd+1, args.L, device=device, requires_grad=True)
+        with torch.no_grad():
+            t_loop, ref = timeit(lambda: loop_pool(H, inner_attention), args.repeat, device)
+            t_batch, out = timeit(lambda: batched_pool(H, inner_attention), args.repeat, device)
+        b_loop, _ = timeit(lambda: loop_pool(H, inner_attention), args.repeat, device, backward=True)
+        b_batch, _ = timeit(lambda: batched_pool(H, inner_attention), args.repeat, device, backward=True)
+        print('{:>8} {:>11.3f} {:>11.3f} {:>7.1f}x {:>14.3f} {:>14.3f} {:>7.1f}x {:>9.2e}'.format(
+            n, t_loop*1e3, t_batch*1e3, t_loop / t_batch, b_loop*1e3, b_batch*1e3, b_loop / b_batch, (ref - out).abs().max().item()))
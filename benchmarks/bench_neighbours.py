@@ -0,0 +1,58 @@
+from __future__ import print_function
+import numpy as np
+import argparse
+import os
+import sys
+import time
+from sklearn.neighbors import NearestNeighbors
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main_scripts'))
+from slide_index import grid_kneighbors
+
+
+def synthetic_slide(n, rng, step=512):
+    # Random-walk tissue with occasional jumps, on a grid of `step` pixels.
+    cells = set()
+    x = y = 0
+    while len(cells) < n:
+        cells.add((x, y))
+        x += rng.integers(-1, 2)
+        y += rng.integers(-1, 2)
+        if rng.random() < 0.001:
+            x += rng.integers(-50, 51)
+            y += rng.integers(-50, 51)
+    loc = np.array(sorted(cells), dtype=np.int64) * step
+    rng.shuffle(loc)
+    return loc
+
+
+def timeit(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t)
+    return best, out
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='sklearn vs grid neighbour lookup for cluster construction')
+    parser.add_argument('--sizes', default='1000,10000,100000', type=str)
+    parser.add_argument('--extd', default=11, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    rng = np.random.default_rng(args.seed)
+    k = args.extd + 1
+    print('{:>8} {:>12} {:>12} {:>8} {:>10}'.format('tiles', 'sklearn(s)', 'grid(s)', 'speedup', 'dist-eq'))
+    for n in map(int, args.sizes.split(',')):
+        loc = synthetic_slide(n, rng)
+        t_sk, nb_sk = timeit(lambda: NearestNeighbors(n_neighbors=k).fit(loc).kneighbors(loc, return_distance=False), args.repeat)
+        t_gr, nb_gr = timeit(lambda: grid_kneighbors(loc, loc, k), args.repeat)
+        d_sk = np.sort(np.linalg.norm(loc[nb_sk] - loc[:, None], axis=2), axis=1)
+        d_gr = np.sort(np.linalg.norm(loc[nb_gr] - loc[:, None], axis=2), axis=1)
+        print('{:>8} {:>12.4f} {:>12.4f} {:>7.1f}x {:>10}'.format(
+            n, t_sk, t_gr, t_sk / t_gr, str(bool(np.allclose(d_sk, d_gr)))))
@@ -0,0 +1,59 @@
+from __future__ import print_function
+import argparse
+import copy
+import os
+import sys
+import time
+import warnings
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main_scripts'))
+from mil_model import Attention_Gated, PRECISIONS, inference_precision
+
+
+def score(model, slides, precision, memory_format):
+    # Slide-level Y_prob of every slide, as MILTest's eval_model runs it.
+    out = []
+    with torch.no_grad():
+        for x in slides:
+            with inference_precision(precision, 'cpu'):
+                out.append(model(x.contiguous(memory_format=memory_format)))
+    return torch.cat(out)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='CPU inference of Attention_Gated in fp32 vs bfloat16 autocast, contiguous vs channels-last: slide-level Y_prob difference to fp32 and tile throughput')
+    parser.add_argument('--models', default='inceptionv3,resnet50', type=str, help='comma separated backbone names')
+    parser.add_argument('--slides', default=4, type=int)
+    parser.add_argument('--clusters', default=4, type=int, help='clusters per slide')
+    parser.add_argument('--extd', default=7, type=int)
+    parser.add_argument('--size', default=299, type=int, help='tile size')
+    parser.add_argument('--repeat', default=2, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    warnings.filterwarnings('ignore')
+    torch.manual_seed(0)
+    bf16 = getattr(torch.ops.mkldnn, '_is_mkldnn_bf16_supported', lambda: False)()
+    print('{} slides x {} clusters x {} tiles of {}px, {} threads, native bf16: {}'.format(
+        args.slides, args.clusters, args.extd+1, args.size, torch.get_num_threads(), bf16))
+    print('{:>12} {:>9} {:>13} {:>10} {:>8} {:>9}'.format('model', 'precision', 'channels_last', 'tiles/s', 'speedup', 'max|dY|'))
+    slides = [torch.randn(args.clusters*(args.extd+1), 3, args.size, args.size) for _ in range(args.slides)]
+    tiles = args.slides * args.clusters * (args.extd+1)
+    for name in args.models.split(','):
+        net = Attention_Gated(name, pretrain=False, extd=args.extd).eval()
+        ref = base = None
+        for precision in sorted(PRECISIONS, reverse=True):
+            for memory_format in (torch.contiguous_format, torch.channels_last):
+                model = copy.deepcopy(net).to(memory_format=memory_format)
+                Y_prob = score(model, slides[:1], precision, memory_format)
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    Y_prob = score(model, slides, precision, memory_format)
+                rate = tiles * args.repeat / (time.perf_counter() - start)
+                if ref is None:
+                    ref, base = Y_prob, rate
+                print('{:>12} {:>9} {:>13} {:>10.1f} {:>7.2f}x {:>9.2e}'.format(
+                    name, precision, 'yes' if memory_format == torch.channels_last else 'no',
+                    rate, rate / base, (Y_prob - ref).abs().max().item()))
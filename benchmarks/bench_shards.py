@@ -0,0 +1,70 @@
+from __future__ import print_function
+import numpy as np
+import argparse
+import os
+import sys
+import shutil
+import tempfile
+import time
+from PIL import Image, ImageFilter
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main_scripts'))
+from tile_io import FileReader, ShardReader, pack_dir
+
+
+def make_tiles(root, n, size, rng):
+    # Smoothed noise compresses to roughly the size of real H&E tiles.
+    d = os.path.join(root, 'data', 'P0', 'S0', '10')
+    os.makedirs(d)
+    side = int(np.ceil(np.sqrt(n)))
+    for i in range(n):
+        img = Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+        img.filter(ImageFilter.GaussianBlur(2)).save(os.path.join(d, f'{(i//side)*size}_{(i%side)*size}.jpg'), quality=90)
+    return os.path.join(root, 'data'), d
+
+
+def run(reader, paths, decode):
+    # decode=False stops after the JPEG header is parsed (open + lookup cost).
+    start = time.perf_counter()
+    for p in paths:
+        img = reader.open(p)
+        if decode:
+            img.convert('RGB')
+        img.close()
+    return len(paths) / (time.perf_counter() - start)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Per-file vs packed shard tile read throughput')
+    parser.add_argument('--src', default=None, type=str, help='existing <ptid>/<slide>/<mag> tile directory; synthetic tiles when omitted')
+    parser.add_argument('--tiles', default=2000, type=int)
+    parser.add_argument('--size', default=512, type=int)
+    parser.add_argument('--reads', default=4000, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    rng = np.random.default_rng(args.seed)
+    tmp = tempfile.mkdtemp()
+    try:
+        if args.src is None:
+            data_root, src = make_tiles(tmp, args.tiles, args.size, rng)
+        else:
+            src = os.path.abspath(args.src)
+            data_root = os.path.dirname(os.path.dirname(os.path.dirname(src)))
+        rel = os.path.relpath(src, data_root)
+        shard_root = os.path.join(tmp, 'shards')
+        t = time.perf_counter()
+        n = pack_dir(src, os.path.join(shard_root, rel))
+        print('Packed {} tiles in {:.2f}s'.format(n, time.perf_counter()-t))
+
+        names = sorted(f for f in os.listdir(src) if not f.startswith('.'))
+        paths = [os.path.join(src, names[i]) for i in rng.integers(0, len(names), args.reads)]
+        readers = [('file', FileReader()), ('shard', ShardReader(data_root, shard_root))]
+        print('{:>8} {:>14} {:>16}'.format('reader', 'open(tiles/s)', 'decode(tiles/s)'))
+        for name, reader in readers:
+            print('{:>8} {:>14.0f} {:>16.0f}'.format(name, run(reader, paths, False), run(reader, paths, True)))
+        print('Note: page cache is warm here; on a network filesystem the per-file open/stat cost dominates.')
+    finally:
+        shutil.rmtree(tmp)
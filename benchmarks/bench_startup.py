@@ -0,0 +1,135 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCRIPTS = ['MILTrain', 'MILTest', 'MILHotmap_df', 'CAM_all']
+OPTIONAL = ['apex', 'tensorboardX', 'warmup_scheduler', 'thop', 'pretrainedmodels', 'cv2', 'sklearn', 'scipy', 'pandas', 'matplotlib']
+
+
+def make_slides(root, patients, slides, tiles, size):
+    # Synthetic <ptid>/<slide>/10/<x>_<y>.jpg tiles on a grid, and data_map.
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    data_map = {}
+    for p in range(patients):
+        ptid = 'P{}'.format(p)
+        for s in range(slides):
+            d = os.path.join(root, ptid, 'S{}'.format(s), '10')
+            os.makedirs(d)
+            for i in range(tiles):
+                img = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+                Image.fromarray(img).save(os.path.join(d, '{}_{}.jpg'.format((i // 8) * size, (i % 8) * size)))
+        data_map[ptid] = {'patient-label': p % 2}
+    return data_map
+
+
+def first_batch(name, data, extd, limit):
+    # Runs in a fresh interpreter: import the entry point, index the slides,
+    # load the first batch and run the model on it, timing each step.
+    times = {}
+    start = time.perf_counter()
+    sys.path[:0] = [os.path.join(ROOT, 'main_scripts'), os.path.join(ROOT, 'CAM')]
+    sys.argv = [name]
+    mod = __import__(name)
+    times['import'] = time.perf_counter() - start
+    loaded = [m for m in OPTIONAL if m in sys.modules]
+
+    import torch
+    import torch.distributed as dist
+    from torch.utils.data import DataLoader
+    from torchvision import transforms
+    from mil_model import Attention_Gated
+    from bag_loader import data_prefetcher
+    dist.init_process_group('gloo', init_method='file://' + os.path.join(data, name + '.init'), rank=0, world_size=1)
+    with open(os.path.join(data, 'data_map.json')) as f:
+        mod.data_map = json.load(f)
+    tiles = os.path.join(data, 'tiles') + '/'
+    transform = transforms.Compose([transforms.CenterCrop(384), transforms.Resize(299)])
+    manifest = os.path.join(data, 'manifest-' + name)
+
+    t = time.perf_counter()
+    if name == 'MILTrain':
+        ds = mod.CC_Dataset(tiles, sorted(mod.data_map), Mag='10', transforms=transform, limit=1, extd=extd, manifest=manifest)
+        sampler, collate = mod.DistSlideSampler(ds, padding=4, seed='bench'), mod.fast_collate
+    elif name == 'MILTest':
+        ds = mod.CCDataset(tiles, sorted(mod.data_map), Mag='10', transforms=transform, limit=2, extd=extd, manifest=manifest)
+        sampler, collate = mod.TestDistSlideSampler(ds, limit=limit, balance=True), mod.unique_collate
+    elif name == 'MILHotmap_df':
+        ds = mod.MVIDataset(tiles, 'P0', 'S0', Mag='10', transforms=transform, extd=extd, manifest=manifest)
+        sampler, collate = mod.TestDistSlideSampler(ds, chunk=limit), mod.unique_collate
+    else:
+        ds = mod.CCDataset(tiles, 'P0', 'S0', Mag='10', transforms=transform, extd=extd, manifest=manifest)
+        sampler, collate = mod.TestDistSlideSampler(ds, chunk=limit), mod.fast_collate
+    times['index'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    with data_prefetcher(DataLoader(ds, batch_sampler=sampler, collate_fn=collate), device='cpu') as prefetcher:
+        batch = prefetcher.next()
+    times['batch'] = time.perf_counter() - t
+
+    # Training starts from a fresh model; the other scripts load a checkpoint.
+    t = time.perf_counter()
+    if name == 'MILTrain':
+        model = Attention_Gated('inceptionv3', pretrain=False, extd=extd)
+    else:
+        model = Attention_Gated('inceptionv3', extd=extd, lazy=True)
+        model.load_state_dict(torch.load(os.path.join(data, 'checkpoint.pt')))
+    times['model'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    with torch.no_grad():
+        model.eval()(batch[0], batch[2], batch[4] if len(batch) == 5 else None)
+    times['forward'] = time.perf_counter() - t
+    times['total'] = time.perf_counter() - start
+    print(json.dumps({'times': times, 'loaded': loaded}))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Cold start to first batch of each entry point: import, slide indexing, first batch, model construction and first forward')
+    parser.add_argument('--scripts', default=','.join(SCRIPTS), type=str, help='comma separated entry points')
+    parser.add_argument('--patients', default=4, type=int)
+    parser.add_argument('--slides', default=2, type=int, help='slides per patient')
+    parser.add_argument('--tiles', default=48, type=int, help='tiles per slide')
+    parser.add_argument('--size', default=512, type=int, help='tile size')
+    parser.add_argument('--extd', default=7, type=int)
+    parser.add_argument('--limit', default=4, type=int, help='clusters per evaluation bag or chunk')
+    parser.add_argument('--child', default=None, type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--data', default=None, type=str, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    if args.child:
+        first_batch(args.child, args.data, args.extd, args.limit)
+        # Skip interpreter teardown: native threads left by gloo and the
+        # loaders can abort it after the timings are out.
+        sys.stdout.flush()
+        os._exit(0)
+    data = tempfile.mkdtemp()
+    with open(os.path.join(data, 'data_map.json'), 'w') as f:
+        json.dump(make_slides(os.path.join(data, 'tiles'), args.patients, args.slides, args.tiles, args.size), f)
+    import torch
+    sys.path.insert(0, os.path.join(ROOT, 'main_scripts'))
+    from mil_model import Attention_Gated
+    torch.save(Attention_Gated('inceptionv3', pretrain=False, extd=args.extd).state_dict(), os.path.join(data, 'checkpoint.pt'))
+    print('{} patients x {} slides x {} tiles of {}px; a fresh interpreter and manifest per script'.format(args.patients, args.slides, args.tiles, args.size))
+    print('{:>13} {:>9} {:>9} {:>9} {:>9} {:>10} {:>9}  {}'.format(
+        'script', 'import(s)', 'index(s)', 'batch(s)', 'model(s)', 'forward(s)', 'total(s)', 'optional modules loaded by import'))
+    for name in args.scripts.split(','):
+        out = subprocess.run([sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--child', name, '--data', data,
+                              '--extd', str(args.extd), '--limit', str(args.limit)], stdout=subprocess.PIPE, universal_newlines=True)
+        if out.returncode:
+            print('{:>13} failed'.format(name))
+            continue
+        res = json.loads(out.stdout.strip().split('\n')[-1])
+        t = res['times']
+        print('{:>13} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.2f} {:>9.2f}  {}'.format(
+            name, t['import'], t['index'], t['batch'], t['model'], t['forward'], t['total'], ', '.join(res['loaded']) or '-'))
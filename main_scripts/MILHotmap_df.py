@@ -2,413 +2,108 @@ from __future__ import print_function
 import numpy as np
 import argparse
 import torch
-import torch.nn as nn
-import torch.utils.data as data_utils
-import torch.optim as optim
-from warmup_scheduler import GradualWarmupScheduler
-from torch.autograd import Variable
-from torchvision import models, transforms
-import torch.nn.functional as F
-import pandas as pd
-from tensorboardX import SummaryWriter
-from sklearn.metrics import roc_curve, auc, confusion_matrix
-from sklearn.neighbors import NearestNeighbors
-import matplotlib.pyplot as plt
+from torchvision import transforms
 import random
-from PIL import Image 
-from sklearn import metrics
-import glob
 import os
-import time
-import argparse
 import json
-import apex
-from apex import amp
-from apex.fp16_utils import *
-from apex.parallel import DistributedDataParallel
-from apex.multi_tensor_apply import multi_tensor_applier
-from torch.utils.data import Dataset, DataLoader as DL, Sampler
-from torch.utils.data.distributed import DistributedSampler
-import torchvision
-import random
-import pandas as pd
-import copy
-import shutil
-from thop import profile
-import sys
-from torchvision.utils import save_image
-from torch.autograd import Variable
-from models import Generator
-from datasets import ImageDataset
-from scipy import stats
-import datetime
-import math
-
-plt.switch_backend('Agg')
-
-
-def get_loc(img_name):
-    return np.array(list(map(int,img_name.split('/')[-1].split('.')[0].split('_'))))
+from torch.utils.data import Dataset, DataLoader as DL
+from slide_index import index_slide_cached, compact_index
+from tile_io import get_reader, TileCache, DraftDecode
+from mil_ops import OnlineAttention
+from mil_model import Attention_Gated, PRECISIONS, inference_precision
+from bag_loader import load_bag, data_prefetcher, TestDistSlideSampler, unique_collate
+from embeddings import EmbeddingStore, embedding_batch
 
-
-def resampling(list_0, num):
-    list_1 = copy.deepcopy(list_0)
-    list_2 = copy.deepcopy(list_0)
-    times = num // len(list_2)
-    if times > 1:
-        list_2.extend((times-1)*list_1)
-    random.seed(36)
-    list_2.extend(random.sample(list_2,num-len(list_2)))
-    return list_2
-
-
-def random_del(neb_list):
-    seed = random.randint(0,len(neb_list)-1)
-    neb_list.pop(seed)
-    return neb_list
+HOTMAP_MEAN = (145.28, 85.00, 147.10)
 
 
 class MVIDataset(Dataset):
-    def __init__(self, Data_path, ptid, slide, Mag='5', transforms=None, limit=96, shuffle=False, extd=7):
+    def __init__(self, Data_path, ptid, slide, Mag='5', transforms=None, limit=96, shuffle=False, extd=7, manifest='./manifest/', nb_engine='sklearn', reader=None, tile_cache=None, draft_tolerance=1.0):
         self.ptids = ptid
         self.slide = [(ptid, slide)]
-        
-        index = 0
-        self.patch = []
-        self.label = []
-        self.indices = {}
-        for i, (ptid, slide) in enumerate(self.slide):
-            patches_t = glob.glob(os.path.join(Data_path, ptid, slide, Mag, '*'))
-            patches_a = glob.glob(os.path.join(Data_path, ptid, slide, Mag.split('_')[0], '*'))
-            
-            if len(patches_a) < extd+1:
-                patches_a = resampling(patches_a, extd+1)
-            
-            self.patch.extend(patches_t)
-            self.patch.extend(patches_a)
-            
-            label = data_map[ptid]['patient-label']
-            
-            self.label.extend([label]*len(patches_t))
-            self.label.extend([label]*len(patches_a))
-            
-            range_t = np.arange(index, index+len(patches_t))
-            index += len(patches_t)
-            range_a = np.arange(index, index+len(patches_a))
-            index += len(patches_a)
-            
-            nbs = NearestNeighbors(extd+1).fit(list(map(get_loc, patches_a)))
-            
-            self.indices[(ptid, slide)] = []
-            for i in range(len(patches_t)):
-                nb_list = list(nbs.kneighbors(get_loc(patches_t[i]).reshape(1,-1),
-                                              return_distance=False)[0])[1:]
-                for e in range(len(nb_list)-extd):
-                    random.seed(666*i+e)
-                    nb_list = random_del(nb_list)
-                inx = []
-                for nl in nb_list:
-                    inx.append(range_a[nl])
-                self.indices[(ptid, slide)].append([range_t[i]]+inx)
-
+        slides = index_slide_cached(Data_path, ptid, slide, Mag, extd, data_map, manifest_dir=manifest, engine=nb_engine)
+        self.patch, self.label, self.indices = compact_index(slides)
         self.slide = np.array(self.slide)
-        self.data_transforms = transforms
+        self.data_transforms = DraftDecode(transforms, draft_tolerance) if transforms is not None else None
+        self.reader = reader if reader is not None else get_reader(Data_path)
+        self.cache = None
+        if tile_cache and len(self.patch):
+            shape = np.asarray(self.data_transforms(self.reader.open(self.patch[0]))).shape
+            self.cache = TileCache(tile_cache, self.data_transforms, Data_path, Mag, slides, self.label.offsets, shape)
+        self.store = None
         
     def __len__(self):
         return len(self.patch)
     
+    def name(self, index):
+        return '|'.join(self.patch[index].split('/')[3:])
+
     def __getitem__(self, index):
-        name = '|'.join(self.patch[index].split('/')[3:])
-        img = Image.open(self.patch[index])
+        if self.cache is not None:
+            return self.cache.get(index, self.patch[index], self.reader), self.label[index]
+        img = self.reader.open(self.patch[index])
         label = self.label[index]
         if self.data_transforms is not None:
             img = self.data_transforms(img)
-        return img, label, name
-
-    
-class DistSlideSampler(DistributedSampler):
-    def __init__(self, k, dataset, padding, seed, shuffle=False):
-        super(DistSlideSampler, self).__init__(dataset)
-        self.slide = dataset.slide
-        self.indices = dataset.indices
-        self.padding = padding
-        self.seed = hash(seed)
-        self.g = torch.Generator()
-        
-    def __iter__(self):
-        self.g.manual_seed(self.seed + self.epoch)
-        indices = torch.randperm(
-            len(self.slide) - len(self.slide)%self.num_replicas, 
-            generator=self.g
-        ).tolist()
-        for i in indices[self.rank::self.num_replicas]:
-            ptid, slide = self.slide[i]
-            yield self.get_slide(ptid, slide)
-        
-    def __len__(self):
-        return len(self.slide) // self.num_replicas
-    
-    def get_slide(self, ptid, slide):
-        indice = self.indices[(ptid, slide)]
-        patch_num = len(indice)
-        np.random.seed(self.seed % (2**32) + self.epoch)
-        if patch_num <= self.padding:
-            indice = resampling(indice, self.padding)
-            return np.array(indice).flatten()
-        else:
-            random.seed(time.time()*1000000)
-            indice = random.sample(indice, self.padding)
-            return np.array(indice).flatten()
-        
-    
-class TestDistSlideSampler(DistributedSampler):
-    def __init__(self, k, dataset, limit=512, shuffle=False):
-        super(TestDistSlideSampler, self).__init__(dataset)
-        self.slide = dataset.slide
-        self.indices = dataset.indices
-        self.limit = limit
-        
-    def __len__(self):
-        return len(self.slide) // self.num_replicas
-    
-    def __iter__(self):
-        slide = self.slide[len(self.slide)%self.num_replicas:]
-        for ptid, slide in slide[self.rank::self.num_replicas]:
-            yield self.get_slide(ptid, slide)
-            
-    def get_slide(self, ptid, slide):
-        indice = self.indices[(ptid, slide)]
-        patch_num = len(indice)
-        if patch_num > self.limit:
-#             random.seed(666)
-#             indice = random.sample(indice, self.limit)
-#             random.seed(time.time()*1000000)
-            indice = indice[k*self.limit:min(patch_num, (k+1)*self.limit)]
-            return np.array(indice).flatten()
-        else:
-            return np.array(indice).flatten()
-    
-    
-def fast_collate(batch, memory_format):
-    imgs = [img[0] for img in batch]
-    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
-    names = [name[2] for name in batch]
-    w, h = imgs[0].size[0], imgs[0].size[1]
-    tensor = torch.zeros((len(imgs), 3, h, w), dtype=torch.uint8).contiguous(memory_format=memory_format)
-    for i, img in enumerate(imgs):
-        numpy_array = np.asarray(img, dtype=np.uint8)
-        numpy_array = np.rollaxis(numpy_array, 2)
-        tensor[i] += torch.from_numpy(numpy_array.copy())
-    return tensor, targets, names
-
-
-class data_prefetcher():
-    def __init__(self, loader, dataset='train'):
-        self.loader = iter(loader)
-        self.stream = torch.cuda.Stream()
-        self.mean = torch.tensor([145.28, 85.00, 147.10]).cuda().view(1,3,1,1)
-        self.std = torch.tensor([27.72, 28.29, 19.74]).cuda().view(1,3,1,1)
-        self.preload()
-
-    def preload(self):
-        try:
-            self.next_input, self.next_target, self.next_name = next(self.loader)
-        except StopIteration:
-            self.next_input = None
-            self.next_target = None
-            self.next_name = None
-            return
-        with torch.cuda.stream(self.stream):
-            self.next_input = self.next_input.cuda(non_blocking=True)
-            self.next_target = self.next_target.cuda(non_blocking=True)
-            self.next_input = self.next_input.float()
-            self.next_input = self.next_input.sub_(self.mean).div_(self.std)
-
-    def next(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        input = self.next_input
-        target = self.next_target
-        name = self.next_name
-        if input is not None:
-            input.record_stream(torch.cuda.current_stream())
-        if target is not None:
-            target.record_stream(torch.cuda.current_stream())
-        self.preload()
-        return input, target, name
-    
-    
-class Attention_Gated(nn.Module):
-    def __init__(self, model, pretrain, extd=7):
-        super(Attention_Gated, self).__init__()
-        self.extd = extd
-        self.L = 512
-        self.D = 128
-        self.K = 1
-        
-#         self.feature_extractor = pretrainedmodels.inceptionv4(pretrained='imagenet')
-        self.feature_extractor = torchvision.models.inception_v3(pretrained=True, aux_logits=False)
-        
-#         self.feature_extractor.last_linear = nn.Linear(1536, self.L)
-        self.feature_extractor.fc = nn.Linear(2048, self.L)
-        if args.local_rank == 0:
-            input_test = torch.randn(1, 3, 224, 224)
-            flops, params = profile(self.feature_extractor, inputs=(input_test, ))
-            print('FLOPS:', flops)
-            print('PARAMS:', params)
-#         nn.init.xavier_normal_(self.feature_extractor.last_linear.weight)
-        nn.init.xavier_normal_(self.feature_extractor.fc.weight)
-        
-        self.encoder = nn.TransformerEncoder(
-            nn.TransformerEncoderLayer(d_model=self.L, 
-                                       nhead=8,
-                                       activation='gelu'),
-            num_layers=2,
-            norm=nn.LayerNorm(normalized_shape=self.L, eps=1e-6)
-        )
-        
-        self.inner_attention = nn.Linear(self.L, self.K)
-        nn.init.xavier_normal_(self.inner_attention.weight)
-        
-        self.attention = nn.Linear(self.L, self.K)
-        nn.init.xavier_normal_(self.attention.weight)
-        
-        self.classifier = nn.Sequential(
-            nn.Linear(self.L*self.K, 1),
-            nn.Sigmoid()
-        )
-        nn.init.xavier_normal_(self.classifier[0].weight)
-
-    
-    def forward(self, x):
-        x = x.squeeze(0)
-        H = self.feature_extractor(x)
-        H = H.view((-1, self.extd+1, self.L))
-        H = self.encoder(H.transpose(0,1))
-        H = H.transpose(0,1)
-        
-        H = torch.cat([torch.mm(F.softmax(self.inner_attention(h).transpose(0,1), dim=1), h) for h in H], 0)
-        
-        A = self.attention(H)
-        A = torch.transpose(A, 1, 0)
-        A = F.softmax(A, dim=1)
-        
-        M = torch.mm(A, H)
-        Y_prob = self.classifier(M)
-        
-        return A, Y_prob
-        
-        
-class Attention_Gated_Test(Attention_Gated):
-    def forward(self, x):
-        x = x.squeeze(0)
-        H = self.feature_extractor(x)
-        H = H.view((-1, self.extd+1, self.L))
-        H = self.encoder(H.transpose(0,1))
-        H = H.transpose(0,1)
-        
-        H = torch.cat([torch.mm(F.softmax(self.inner_attention(h).transpose(0,1), dim=1), h) for h in H], 0)
-        
-        A = self.attention(H)
-        A = torch.transpose(A, 1, 0)
-        A = F.softmax(A, dim=1)
-        
-        M = torch.mm(A, H)
-        Y_prob = self.classifier(M)
-        
-        return A, Y_prob
-
-            
-def reduce_tensor(tensor: torch.Tensor) -> torch.Tensor:
-    rt = tensor.clone()
-    torch.distributed.all_reduce(rt, op=torch.distributed.ReduceOp.SUM)
-    return rt
-
-
-def gather_tensor(tensor: torch.Tensor):
-    rt = tensor.clone()
-    var_list = [torch.zeros_like(rt) for _ in range(torch.distributed.get_world_size())]
-    torch.distributed.all_gather(var_list, rt, async_op=False)
-    return [i.item() for i in var_list]
-
-
-def eval_model(args, dataloader, model, k):
+        return img, label
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        if self.store is not None:
+            # Bags whose embeddings are all stored skip decoding altogether.
+            uniq, inverse = np.unique(indices, return_inverse=True)
+            H, hit = self.store.lookup(uniq)
+            if hit.all():
+                return embedding_batch(H, self.label, indices) + (torch.from_numpy(uniq), torch.from_numpy(inverse.reshape(-1)))
+        return load_bag(indices, self.__getitem__)
+
+    
+def eval_model(args, dataloader, model, device, store=None):
+    # The slide's clusters arrive in chunks of test_limit. Only the cluster
+    # features of one chunk are held at a time; the attention logits are
+    # kept and normalized over all clusters at the end, so Prob and Y_prob
+    # equal one softmax over the whole slide.
     model.eval()
-    all_labels = []
-    all_values = []
-    train_loss = 0
-    
-    prefetcher = data_prefetcher(dataloader)
-    patches, label, name = prefetcher.next()
-    index = 0
-    prob_df = pd.DataFrame({'Center':[], 'Neighb':[], 'Prob':[]})
-    while patches is not None:
-        index += 1
-        label = label[0].float()
-        
-        with torch.no_grad():
-            A, Y_prob= model.forward(patches)
-#             print('-'*30)
-            prob = list(np.array(A[0].cpu()))
-#             print(prob)
-            center = []
-            neighb = []
+    net = model.module
+    pool = OnlineAttention()
+    scores = []
+    center = []
+    neighb = []
+    
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    with data_prefetcher(dataloader, mean=HOTMAP_MEAN, memory_format=memory_format, device=device, width=5) as prefetcher:
+        patches, label, segments, indices, inverse = prefetcher.next()
+        if patches is None:
+            return None
+        target = label[0].float()
+        while patches is not None:
+            with torch.no_grad():
+                with inference_precision(args.precision, device):
+                    if store is not None and patches.dim() == 4:
+                        patches = store.embed(net.feature_extractor, patches, indices)
+                    H = net.clusters(patches, inverse).float()
+                A = net.attention(H).squeeze(1)
+                pool.add(H, A)
+            scores.append(A.cpu())
+            name = [dataloader.dataset.name(int(i)) for i in indices.cpu()[inverse.cpu()]]
             for i in range(0, len(name), args.extd+1):
                 center.append(name[i])
                 neighb.append(name[i+1:i+args.extd+1])
-#             print(center)
-#             print(neighb)
-            prob_df = prob_df.append(pd.DataFrame({'Center':center, 'Neighb':neighb, 'Prob':prob}))
-            Y_prob = torch.clamp(Y_prob, min=1e-5, max=1. - 1e-5)
-        
-        all_labels.extend(gather_tensor(label))
-        all_values.extend(gather_tensor(Y_prob[0][0]))
         
-        patches, label, name = prefetcher.next()
-            
+            patches, label, segments, indices, inverse = prefetcher.next()
+    
+    with torch.no_grad():
+        Y_prob = torch.clamp(net.classifier(pool.pool()), min=1e-5, max=1. - 1e-5)
+    prob = (torch.cat(scores) - pool.logsumexp().cpu()).exp()
     if args.local_rank == 0:
-        print(len(all_labels))
-        prob_df = prob_df.reset_index(drop=True)
-        prob_df.to_excel(f'./df_middle/prob_df_{k}.xlsx', index=None)
+        print('Label:', target.item(), 'Y_prob:', Y_prob.item())
+        print(dataloader.batch_sampler.counter)
         
-    return
+    import pandas as pd
+    return pd.DataFrame({'Center':center, 'Neighb':neighb, 'Prob':prob.tolist()})
 
     
     
-def get_cm(AllLabels, AllValues):
-    fpr, tpr, threshold = roc_curve(AllLabels, AllValues, pos_label=1)
-    Auc = auc(fpr, tpr)
-    m = t = 0
-
-    for i in range(len(threshold)):
-        if tpr[i] - fpr[i] > m :
-            m = abs(-fpr[i]+tpr[i])
-            t = threshold[i]
-    AllPred = [int(i>=t) for i in AllValues]
-    Acc = sum([AllLabels[i] == AllPred[i] for i in range(len(AllPred))]) / len(AllPred)
-
-    Pos_num = sum(AllLabels)
-    Neg_num = len(AllLabels) - Pos_num
-    cm = confusion_matrix(AllLabels, AllPred)
-    print("[AUC/{:.4f}] [Threshold/{:.4f}] [Acc/{:.4f}]".format(Auc, t,  Acc))
-    print("{:.2f}% {:.2f}%".format(cm[0][0]/ Neg_num * 100, cm[0][1]/Neg_num * 100))
-    print("{:.2f}% {:.2f}%".format(cm[1][0]/ Pos_num * 100, cm[1][1]/Pos_num * 100))
-    
-    return Auc, Acc
-
-
-def get_auc(ture, pred):
-    fpr, tpr, thresholds = metrics.roc_curve(ture, pred, pos_label=1)
-    return metrics.auc(fpr, tpr)
-
-
-def save_roc(ture, pred, imgn):
-    fpr, tpr, thresholds = metrics.roc_curve(ture, pred, pos_label=1)
-    plt.cla()
-    plt.plot(fpr,tpr)
-    plt.savefig(f'{imgn}.jpg')
-    return
-
-
 def get_parser():
     parser = argparse.ArgumentParser(description='PyTorch Implementation of multiple Instance learning')
     parser.add_argument('--path', default='None', type=str)
@@ -417,9 +112,19 @@ def get_parser():
     parser.add_argument('--fold', default='0', type=str)
     parser.add_argument('--epo', default='5', type=str)
     parser.add_argument('--model', default=18, type=str)
-    parser.add_argument('--test_limit', default=50, type=int)
+    parser.add_argument('--test_limit', default=50, type=int, help='clusters per forward pass; every cluster of the slide is evaluated and the attention normalized over all of them')
     parser.add_argument('--extd', default=7, type=int)
     parser.add_argument('--option', default='TEST', type=str)
+    parser.add_argument('--manifest', default='./manifest/', type=str, help='slide/tile manifest cache directory')
+    parser.add_argument('--nb_engine', default='sklearn', type=str, help='neighbour engine for clusters: sklearn or grid')
+    parser.add_argument('--shards', default=None, type=str, help='root of packed tile shards (see pack_shards.py)')
+    parser.add_argument('--tile_cache', default=None, type=str, help='directory of the memory-mapped cache of transformed evaluation tiles')
+    parser.add_argument('--draft_tolerance', default=1.0, type=float, help='decode JPEG tiles at 1/2-1/8 scale when the first Resize then upsamples by at most this factor (1.0: lossless only)')
+    parser.add_argument('--embedding_store', default=None, type=str, help='directory of the persistent store of backbone embeddings, reused by checkpoints with unchanged backbone weights and by later runs')
+    parser.add_argument('--embedding_store_gb', default=None, type=float, help='size bound of the embedding store; least recently used slides are evicted beyond it')
+    parser.add_argument('--precision', default='fp32', choices=sorted(PRECISIONS), help="'bf16' runs the backbone and cluster encoder under bfloat16 autocast; the slide attention, Prob and Y_prob stay fp32")
+    parser.add_argument('--channels_last', action='store_true', help='keep the backbone weights and tiles in channels-last memory format')
+    parser.add_argument('--profile', action='store_true', help='print the FLOPs and parameter count of the backbone (needs thop)')
     parser.add_argument('--local_rank', type=int, default=0)
     parser.add_argument('--init_method', type=str)
     return parser.parse_args()
@@ -436,10 +141,11 @@ if __name__ == '__main__':
                 transforms.Resize(299),
             ])
     
-    torch.backends.cudnn.benchmark = True
-    torch.cuda.set_device(args.local_rank)
+    if torch.cuda.is_available():
+        torch.backends.cudnn.benchmark = True
+        torch.cuda.set_device(args.local_rank)
     torch.distributed.init_process_group(
-        'nccl',
+        'nccl' if torch.cuda.is_available() else 'gloo',
         init_method=args.init_method
     )
     
@@ -450,6 +156,7 @@ if __name__ == '__main__':
         os.mkdir('./df_final/X40/')
     
     data_path = args.path
+    import pandas as pd
     pat_slide_all = pd.read_excel('pat_slide_all.xlsx')
     avlb_slide = os.listdir(data_path)
     
@@ -466,16 +173,38 @@ if __name__ == '__main__':
     old_neg = list(set(pd.read_excel('old_slide_all.xlsx')['old_slide'].tolist())&set(test0_label))
     test0_label = list(set(test0_label)-set(old_neg))
     
+    # One model for every slide, loaded from the checkpoint once.
+    device = torch.device(f"cuda:{args.local_rank}") if torch.cuda.is_available() else torch.device('cpu')
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+
+    model = Attention_Gated(args.model, extd=args.extd, lazy=True, profile=args.profile and args.local_rank == 0)
+    if device.type == 'cuda':
+        import apex
+        from apex import amp
+        from apex.parallel import DistributedDataParallel
+        model = apex.parallel.convert_syncbn_model(model).to(device, memory_format=memory_format)
+        model = amp.initialize(model,opt_level="O0", keep_batchnorm_fp32=None)
+        model = DistributedDataParallel(model, delay_allreduce=True)
+    else:
+        # Ranks draw different slides: no collective per forward.
+        model = torch.nn.parallel.DistributedDataParallel(model.to(memory_format=memory_format), broadcast_buffers=False)
+
+    mg = args.mag.split('_')[0]
+    option = args.option
+    epo = args.epo
+    print('-'*30)
+    print('Testing mag:', mg)
+    print('Model epo:', epo)
+    print('-'*30)
+    path = f'./checkpoints_{mg}X_{args.sample}_F{args.fold}/comment/{epo}.pt'
+    model.load_state_dict(torch.load(path, map_location=device))
+    
     hotmap_pat = list(set(test0_label)-set([f.split('_')[3] for f in os.listdir(f'./df_final/X{args.mag}/')]))
+    store = None
     for hp in hotmap_pat:
         hotmap_slide = os.listdir(args.path+hp)
         for hs in hotmap_slide:
             try:
-                if not os.path.exists('./df_middle/'):
-                    os.mkdir('./df_middle/')
-                else:
-                    shutil.rmtree('./df_middle/')
-                    os.mkdir('./df_middle/')
                 eval_datasets = MVIDataset(args.path, 
                                            hp, 
                                            hs,
@@ -486,55 +215,41 @@ if __name__ == '__main__':
                                             ]),
                                            limit=1,
                                            shuffle=False,
-                                           extd=args.extd)
-
-                memory_format = torch.contiguous_format
-                collate_fn = lambda b: fast_collate(b, memory_format)
-
-                numslide = len(os.listdir(args.path+'/'+hp+'/'+hs+'/'+args.mag+'/'))
-                times = numslide//int(args.test_limit)+1
-                print('Num of all clusters:', len(os.listdir(args.path+'/'+hp+'/'+hs+'/'+args.mag+'/')))
-                print('Loops:', str(time))
-
-                for k in range(times):
-                    print('Sampling cluster:', k*int(args.test_limit), 'to', min(numslide, (k+1)*int(args.test_limit)))
-                    sampler = TestDistSlideSampler(k, eval_datasets, limit=args.test_limit)
-                    eval_loader = DL(eval_datasets, 
-                                     batch_sampler=sampler,
-                                     num_workers=16,
-                                     pin_memory=True,
-                                     collate_fn=collate_fn,
-                                     shuffle=False)
-
-            #         if args.local_rank == 0:
-            #             print(' slide number:', len(eval_datasets.slide))
-            #             print(' patches number:', len(eval_datasets))
-
-                    device = torch.device(f"cuda:{args.local_rank}")
-
-                    model = apex.parallel.convert_syncbn_model(
-                        Attention_Gated(args.model, True, extd=args.extd)
-                    ).to(device)
-
-                    model = amp.initialize(model,opt_level="O0", keep_batchnorm_fp32=None)
-                    model = DistributedDataParallel(model, delay_allreduce=True)
-
-                    mg = args.mag.split('_')[0]
-                    option = args.option
-                    epo = args.epo
-                    print('-'*30)
-                    print('Testing mag:', mg)
-                    print('Model epo:', epo)
-                    print('-'*30)
-                    path = f'./checkpoints_{mg}X_{args.sample}_F{args.fold}/comment/{epo}.pt'
-                    model.load_state_dict(torch.load(path))
-                    eval_model(args, eval_loader, model, k)
-
-                df_0 = pd.read_excel('./df_middle/prob_df_0.xlsx')
-                for k in range(1,times):
-                    df_k = pd.read_excel(f'./df_middle/prob_df_{k}.xlsx')
-                    df_0 = df_0.append(df_k)
-
-                df_0.to_excel(f'./df_final/X{args.mag}/prob_df_{args.mag}X_{hp}_{hs}.xlsx')
+                                           extd=args.extd,
+                                           manifest=args.manifest,
+                                           nb_engine=args.nb_engine,
+                                           reader=get_reader(args.path, args.shards),
+                                           tile_cache=args.tile_cache,
+                                           draft_tolerance=args.draft_tolerance)
+
+                collate_fn = unique_collate
+
+                sampler = TestDistSlideSampler(eval_datasets, chunk=args.test_limit)
+                print('Num of all clusters:', len(eval_datasets.indices[(hp, hs)]))
+                print('Loops:', len(sampler))
+                eval_loader = DL(eval_datasets, 
+                                 batch_sampler=sampler,
+                                 num_workers=16,
+                                 pin_memory=True,
+                                 collate_fn=collate_fn,
+                                 shuffle=False)
+
+        #         if args.local_rank == 0:
+        #             print(' slide number:', len(eval_datasets.slide))
+        #             print(' patches number:', len(eval_datasets))
+
+                # Built for the first slide; the weights hash and size walk
+                # are kept, later slides only swap in their tiles.
+                if args.embedding_store:
+                    if store is None:
+                        max_bytes = int(args.embedding_store_gb * 2**30) if args.embedding_store_gb else None
+                        store = EmbeddingStore(args.embedding_store, model.module.feature_extractor, eval_datasets, args.path, args.mag, mean=HOTMAP_MEAN, width=model.module.L, max_bytes=max_bytes, precision=args.precision)
+                    else:
+                        store.use(eval_datasets)
+                eval_datasets.store = store
+                prob_df = eval_model(args, eval_loader, model, device, store)
+
+                if args.local_rank == 0 and prob_df is not None:
+                    prob_df.to_excel(f'./df_final/X{args.mag}/prob_df_{args.mag}X_{hp}_{hs}.xlsx')
             except Exception:
                 pass
\ No newline at end of file
@@ -2,415 +2,157 @@ from __future__ import print_function
 import numpy as np
 import argparse
 import torch
-import torch.nn as nn
-import torch.utils.data as data_utils
-import torch.optim as optim
-from warmup_scheduler import GradualWarmupScheduler
-from torch.autograd import Variable
-from torchvision import models, transforms
-import torch.nn.functional as F
-import pandas as pd
-from tensorboardX import SummaryWriter
-from sklearn.metrics import roc_curve, auc, confusion_matrix
-from sklearn.neighbors import NearestNeighbors
-import matplotlib.pyplot as plt
+from torchvision import transforms
 import random
-from PIL import Image 
-from sklearn import metrics
-import glob
 import os
-import time
-import argparse
 import json
-import apex
-from apex import amp
-from apex.fp16_utils import *
-from apex.parallel import DistributedDataParallel
-from apex.multi_tensor_apply import multi_tensor_applier
-from torch.utils.data import Dataset, DataLoader as DL, Sampler
-from torch.utils.data.distributed import DistributedSampler
-import torchvision
-import random
-import pandas as pd
-import copy
-from thop import profile
-import sys
-from torchvision.utils import save_image
-from torch.autograd import Variable
-from models import Generator
-from datasets import ImageDataset
-from scipy import stats
+from torch.utils.data import Dataset, DataLoader as DL
 import datetime
 import math
-
-
-plt.switch_backend('Agg')
-
-
-def get_loc(img_name):
-    return np.array(list(map(int,img_name.split('/')[-1].split('.')[0].split('_'))))
-
-
-def resampling(list_0, num):
-    list_1 = copy.deepcopy(list_0)
-    list_2 = copy.deepcopy(list_0)
-    times = num // len(list_2)
-    if times > 1:
-        list_2.extend((times-1)*list_1)
-    random.seed(36)
-    list_2.extend(random.sample(list_2,num-len(list_2)))
-    return list_2
-
-
-def random_del(neb_list):
-    seed = random.randint(0,len(neb_list)-1)
-    neb_list.pop(seed)
-    return neb_list
+from slide_index import index_slides, compact_index
+from tile_io import get_reader, TileCache, DraftDecode
+from mil_ops import segment_ids, segment_starts, OnlineAttention
+from mil_model import Attention_Gated, PRECISIONS, inference_precision, gather_ordered, get_cm, get_auc, save_roc
+from bag_loader import load_bag, data_prefetcher, TestDistSlideSampler, unique_collate
+from embeddings import EmbeddingStore, embedding_batch
 
 
 class CCDataset(Dataset):
-    def __init__(self, Data_path, ptids, Mag='5', transforms=None, limit=96, shuffle=False, extd=7):
+    def __init__(self, Data_path, ptids, Mag='5', transforms=None, limit=96, shuffle=False, extd=7, manifest='./manifest/', nb_engine='sklearn', reader=None, tile_cache=None, draft_tolerance=1.0, workers=1):
         self.ptids = ptids
-        self.slide = [
-            (ptid, slide) 
-            for ptid in ptids
-            for slide in os.listdir(os.path.join(Data_path, ptid))
-            if limit <= len(glob.glob(os.path.join(Data_path, ptid, slide, Mag, '*')))
-        ]
-        
-        index = 0
-        self.patch = []
-        self.label = []
-        self.indices = {}
-        for i, (ptid, slide) in enumerate(self.slide):
-            patches_t = glob.glob(os.path.join(Data_path, ptid, slide, Mag, '*'))
-            patches_a = glob.glob(os.path.join(Data_path, ptid, slide, Mag.split('_')[0], '*'))
-            
-            if len(patches_a) < extd+1:
-                patches_a = resampling(patches_a, extd+1)
-            
-            self.patch.extend(patches_t)
-            self.patch.extend(patches_a)
-            
-            label = data_map[ptid]['patient-label']
-            
-            self.label.extend([label]*len(patches_t))
-            self.label.extend([label]*len(patches_a))
-            
-            range_t = np.arange(index, index+len(patches_t))
-            index += len(patches_t)
-            range_a = np.arange(index, index+len(patches_a))
-            index += len(patches_a)
-            
-            nbs = NearestNeighbors(extd+1).fit(list(map(get_loc, patches_a)))
-            
-            self.indices[(ptid, slide)] = []
-            for i in range(len(patches_t)):
-                nb_list = list(nbs.kneighbors(get_loc(patches_t[i]).reshape(1,-1),
-                                              return_distance=False)[0])[1:]
-                for e in range(len(nb_list)-extd):
-                    random.seed(666*i+e)
-                    nb_list = random_del(nb_list)
-                inx = []
-                for nl in nb_list:
-                    inx.append(range_a[nl])
-                self.indices[(ptid, slide)].append([range_t[i]]+inx)
-
+        slides = index_slides(Data_path, ptids, Mag, extd, data_map, limit=limit, manifest_dir=manifest, engine=nb_engine, workers=workers)
+        self.slide = [(ptid, slide) for ptid, slide, _ in slides]
+        self.patch, self.label, self.indices = compact_index(slides)
         self.slide = np.array(self.slide)
-        self.data_transforms = transforms
+        self.data_transforms = DraftDecode(transforms, draft_tolerance) if transforms is not None else None
+        self.reader = reader if reader is not None else get_reader(Data_path)
+        self.cache = None
+        if tile_cache and len(self.patch):
+            shape = np.asarray(self.data_transforms(self.reader.open(self.patch[0]))).shape
+            self.cache = TileCache(tile_cache, self.data_transforms, Data_path, Mag, slides, self.label.offsets, shape)
+        self.store = None
         
     def __len__(self):
         return len(self.patch)
     
     def __getitem__(self, index):
-        img = Image.open(self.patch[index])
+        if self.cache is not None:
+            return self.cache.get(index, self.patch[index], self.reader), self.label[index]
+        img = self.reader.open(self.patch[index])
         label = self.label[index]
         if self.data_transforms is not None:
             img = self.data_transforms(img)
         return img, label
 
-    
-class DistSlideSampler(DistributedSampler):
-    def __init__(self, dataset, padding, seed, shuffle=False):
-        super(DistSlideSampler, self).__init__(dataset)
-        self.slide = dataset.slide
-        self.indices = dataset.indices
-        self.padding = padding
-        self.seed = hash(seed)
-        self.g = torch.Generator()
-        
-    def __iter__(self):
-        self.g.manual_seed(self.seed + self.epoch)
-        indices = torch.randperm(
-            len(self.slide) - len(self.slide)%self.num_replicas, 
-            generator=self.g
-        ).tolist()
-        for i in indices[self.rank::self.num_replicas]:
-            ptid, slide = self.slide[i]
-            yield self.get_slide(ptid, slide)
-        
-    def __len__(self):
-        return len(self.slide) // self.num_replicas
-    
-    def get_slide(self, ptid, slide):
-        indice = self.indices[(ptid, slide)]
-        patch_num = len(indice)
-        np.random.seed(self.seed % (2**32) + self.epoch)
-        if patch_num <= self.padding:
-            indice = resampling(indice, self.padding)
-            return np.array(indice).flatten()
-        else:
-            random.seed(time.time()*1000000)
-            indice = random.sample(indice, self.padding)
-            return np.array(indice).flatten()
-        
-    
-class TestDistSlideSampler(DistributedSampler):
-    def __init__(self, dataset, limit=512, shuffle=False):
-        super(TestDistSlideSampler, self).__init__(dataset)
-        self.slide = dataset.slide
-        self.indices = dataset.indices
-        self.limit = limit
-        
-    def __len__(self):
-        return len(self.slide) // self.num_replicas
-    
-    def __iter__(self):
-        slide = self.slide[len(self.slide)%self.num_replicas:]
-        for ptid, slide in slide[self.rank::self.num_replicas]:
-            yield self.get_slide(ptid, slide)
-            
-    def get_slide(self, ptid, slide):
-        indice = self.indices[(ptid, slide)]
-        patch_num = len(indice)
-        if patch_num > self.limit:
-            random.seed(666)
-            indice = random.sample(indice, self.limit)
-            random.seed(time.time()*1000000)
-            return np.array(indice).flatten()
-        else:
-            return np.array(indice).flatten()
-    
-    
-def fast_collate(batch, memory_format):
-    imgs = [img[0] for img in batch]
-    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
-    w, h = imgs[0].size[0], imgs[0].size[1]
-    tensor = torch.zeros((len(imgs), 3, h, w), dtype=torch.uint8).contiguous(memory_format=memory_format)
-    for i, img in enumerate(imgs):
-        numpy_array = np.asarray(img, dtype=np.uint8)
-        numpy_array = np.rollaxis(numpy_array, 2)
-        tensor[i] += torch.from_numpy(numpy_array.copy())
-    return tensor, targets
-
-
-class data_prefetcher():
-    def __init__(self, loader, dataset='train'):
-        self.loader = iter(loader)
-        self.stream = torch.cuda.Stream()
-        if dataset=='test2____':
-            self.mean = torch.tensor([179.39, 105.45, 168.53]).cuda().view(1,3,1,1)
-            self.std = torch.tensor([25.39, 31.86, 19.66]).cuda().view(1,3,1,1)
-        else:
-            self.mean = torch.tensor([165.65, 100.58, 156.62]).cuda().view(1,3,1,1)
-            self.std = torch.tensor([27.72, 28.29, 19.74]).cuda().view(1,3,1,1)
-        self.preload()
-
-    def preload(self):
-        try:
-            self.next_input, self.next_target = next(self.loader)
-        except StopIteration:
-            self.next_input = None
-            self.next_target = None
-            return
-        with torch.cuda.stream(self.stream):
-            self.next_input = self.next_input.cuda(non_blocking=True)
-            self.next_target = self.next_target.cuda(non_blocking=True)
-            self.next_input = self.next_input.float()
-            self.next_input = self.next_input.sub_(self.mean).div_(self.std)
-
-    def next(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        input = self.next_input
-        target = self.next_target
-        if input is not None:
-            input.record_stream(torch.cuda.current_stream())
-        if target is not None:
-            target.record_stream(torch.cuda.current_stream())
-        self.preload()
-        return input, target
-    
-    
-class Attention_Gated(nn.Module):
-    def __init__(self, model, pretrain, extd=7):
-        super(Attention_Gated, self).__init__()
-        self.extd = extd
-        self.L = 512
-        self.D = 128
-        self.K = 1
-        
-#         self.feature_extractor = pretrainedmodels.inceptionv4(pretrained='imagenet')
-        self.feature_extractor = torchvision.models.inception_v3(pretrained=True, aux_logits=False)
-        
-#         self.feature_extractor.last_linear = nn.Linear(1536, self.L)
-        self.feature_extractor.fc = nn.Linear(2048, self.L)
-        if args.local_rank == 0:
-            input_test = torch.randn(1, 3, 224, 224)
-            flops, params = profile(self.feature_extractor, inputs=(input_test, ))
-            print('FLOPS:', flops)
-            print('PARAMS:', params)
-#         nn.init.xavier_normal_(self.feature_extractor.last_linear.weight)
-        nn.init.xavier_normal_(self.feature_extractor.fc.weight)
-        
-        self.encoder = nn.TransformerEncoder(
-            nn.TransformerEncoderLayer(d_model=self.L, 
-                                       nhead=8,
-                                       activation='gelu'),
-            num_layers=2,
-            norm=nn.LayerNorm(normalized_shape=self.L, eps=1e-6)
-        )
-        
-        self.inner_attention = nn.Linear(self.L, self.K)
-        nn.init.xavier_normal_(self.inner_attention.weight)
-        
-        self.attention = nn.Linear(self.L, self.K)
-        nn.init.xavier_normal_(self.attention.weight)
-        
-        self.classifier = nn.Sequential(
-            nn.Linear(self.L*self.K, 1),
-            nn.Sigmoid()
-        )
-        nn.init.xavier_normal_(self.classifier[0].weight)
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        if self.store is not None:
+            # Bags whose embeddings are all stored skip decoding altogether.
+            uniq, inverse = np.unique(indices, return_inverse=True)
+            H, hit = self.store.lookup(uniq)
+            if hit.all():
+                return embedding_batch(H, self.label, indices) + (torch.from_numpy(uniq), torch.from_numpy(inverse.reshape(-1)))
+        bag = load_bag(indices, self.__getitem__)
+        bag.segments = segment_ids(self.label.offsets, indices)
+        return bag
 
     
-    def forward(self, x):
-        x = x.squeeze(0)
-        H = self.feature_extractor(x)
-        H = H.view((-1, self.extd+1, self.L))
-        H = self.encoder(H.transpose(0,1))
-        H = H.transpose(0,1)
-        
-        H = torch.cat([torch.mm(F.softmax(self.inner_attention(h).transpose(0,1), dim=1), h) for h in H], 0)
-        
-        A = self.attention(H)
-        A = torch.transpose(A, 1, 0)
-        A = F.softmax(A, dim=1)
-        
-        M = torch.mm(A, H)
-        Y_prob = self.classifier(M)
-        
-        return Y_prob
-        
-        
-class Attention_Gated_Test(Attention_Gated):
-    def forward(self, x):
-        x = x.squeeze(0)
-        H = self.feature_extractor(x)
-        H = H.view((-1, self.extd+1, self.L))
-        H = self.encoder(H.transpose(0,1))
-        H = H.transpose(0,1)
-        
-        H = torch.cat([torch.mm(F.softmax(self.inner_attention(h).transpose(0,1), dim=1), h) for h in H], 0)
+def eval_model(args, dataloader, model, device, store=None):
+    model.eval()
+    all_labels = []
+    all_values = []
+    all_losses = []
+    
+    with data_prefetcher(dataloader, memory_format=memory_format(args), device=device, width=5) as prefetcher:
+        patches, label, segments, indices, inverse = prefetcher.next()
+        index = 0
+        while patches is not None:
+            index += 1
+            label = label[segment_starts(segments)].float().view(-1, 1)
         
-        A = self.attention(H)
-        A = torch.transpose(A, 1, 0)
-        A = F.softmax(A, dim=1)
+            with torch.no_grad():
+                with inference_precision(args.precision, device):
+                    if store is not None and patches.dim() == 4:
+                        patches = store.embed(model.module.feature_extractor, patches, indices)
+                    Y_prob= model.forward(patches, segments, inverse)
+                Y_prob = torch.clamp(Y_prob, min=1e-5, max=1. - 1e-5)
+
+                J = -1.*(
+                    label*torch.log(Y_prob)+
+                    (1.-label)*torch.log(1.-Y_prob)
+                )
         
-        M = torch.mm(A, H)
-        Y_prob = self.classifier(M)
+            all_losses.extend(J.view(-1).tolist())
+            all_labels.extend(label.view(-1).tolist())
+            all_values.extend(Y_prob[:, 0].tolist())
         
-        return Y_prob
-
+            patches, label, segments, indices, inverse = prefetcher.next()
             
-def reduce_tensor(tensor: torch.Tensor) -> torch.Tensor:
-    rt = tensor.clone()
-    torch.distributed.all_reduce(rt, op=torch.distributed.ReduceOp.SUM)
-    return rt
-
-
-def gather_tensor(tensor: torch.Tensor):
-    rt = tensor.clone()
-    var_list = [torch.zeros_like(rt) for _ in range(torch.distributed.get_world_size())]
-    torch.distributed.all_gather(var_list, rt, async_op=False)
-    return [i.item() for i in var_list]
+    return report(args, dataloader, all_labels, all_values, all_losses)
 
 
-def eval_model(args, dataloader, model):
+def stream_model(args, dataloader, model, device, store=None):
+    # Every cluster of a slide, in the sampler's chunks. Only the cluster
+    # features of one chunk are held at a time; the slide attention is
+    # accumulated online, so Y_prob equals one softmax over the whole bag.
     model.eval()
+    net = model.module
+    offsets = dataloader.dataset.label.offsets
     all_labels = []
     all_values = []
-    train_loss = 0
+    all_losses = []
     
-    prefetcher = data_prefetcher(dataloader)
-    patches, label = prefetcher.next()
-    index = 0
-    while patches is not None:
-        index += 1
-        label = label[0].float()
+    with data_prefetcher(dataloader, memory_format=memory_format(args), device=device, width=5) as prefetcher:
+        patches, label, segments, indices, inverse = prefetcher.next()
+        pool = None
+        while True:
+            slide = None if patches is None else int(np.searchsorted(offsets, indices[0].item(), side='right')) - 1
+            if pool is not None and slide != current:
+                with torch.no_grad():
+                    Y_prob = torch.clamp(net.classifier(pool.pool()), min=1e-5, max=1. - 1e-5)
+                    J = -1.*(
+                        target*torch.log(Y_prob)+
+                        (1.-target)*torch.log(1.-Y_prob)
+                    )
+                all_losses.extend(J.view(-1).tolist())
+                all_labels.extend(target.view(-1).tolist())
+                all_values.extend(Y_prob[:, 0].tolist())
+                pool = None
+            if patches is None:
+                break
+            if pool is None:
+                pool, current, target = OnlineAttention(), slide, label[:1].float().view(-1, 1)
         
-        with torch.no_grad():
-            Y_prob= model.forward(patches)
-            Y_prob = torch.clamp(Y_prob, min=1e-5, max=1. - 1e-5)
-
-            J = -1.*(
-                label*torch.log(Y_prob)+
-                (1.-label)*torch.log(1.-Y_prob)
-            )
+            with torch.no_grad():
+                with inference_precision(args.precision, device):
+                    if store is not None and patches.dim() == 4:
+                        patches = store.embed(net.feature_extractor, patches, indices)
+                    H = net.clusters(patches, inverse).float()
+                pool.add(H, net.attention(H).squeeze(1))
         
-        reduced_loss = reduce_tensor(J.data)
-        
-        train_loss += reduced_loss.item()
-        all_labels.extend(gather_tensor(label))
-        all_values.extend(gather_tensor(Y_prob[0][0]))
-        
-        patches, label = prefetcher.next()
-            
-            
+            patches, label, segments, indices, inverse = prefetcher.next()
+    
+    return report(args, dataloader, all_labels, all_values, all_losses)
+
+
+def memory_format(args):
+    return torch.channels_last if args.channels_last else torch.contiguous_format
+
+
+def report(args, dataloader, all_labels, all_values, all_losses):
+    positions, all_labels, all_values, all_losses = gather_ordered(dataloader.batch_sampler.positions, all_labels, all_values, all_losses)
+    train_loss = sum(all_losses)
     if args.local_rank == 0:
         print(len(all_labels))
+        print(dataloader.batch_sampler.counter)
         all_labels = np.array(all_labels)
         Loss = train_loss / len(all_labels)
         AUC, Acc = get_cm(all_labels, all_values)
         
-    return all_labels, all_values
+    return all_labels, all_values, positions
 
     
     
-def get_cm(AllLabels, AllValues):
-    fpr, tpr, threshold = roc_curve(AllLabels, AllValues, pos_label=1)
-    Auc = auc(fpr, tpr)
-    m = t = 0
-
-    for i in range(len(threshold)):
-        if tpr[i] - fpr[i] > m :
-            m = abs(-fpr[i]+tpr[i])
-            t = threshold[i]
-    AllPred = [int(i>=t) for i in AllValues]
-    Acc = sum([AllLabels[i] == AllPred[i] for i in range(len(AllPred))]) / len(AllPred)
-
-    Pos_num = sum(AllLabels)
-    Neg_num = len(AllLabels) - Pos_num
-    cm = confusion_matrix(AllLabels, AllPred)
-    print("[AUC/{:.4f}] [Threshold/{:.4f}] [Acc/{:.4f}]".format(Auc, t,  Acc))
-    print("{:.2f}% {:.2f}%".format(cm[0][0]/ Neg_num * 100, cm[0][1]/Neg_num * 100))
-    print("{:.2f}% {:.2f}%".format(cm[1][0]/ Pos_num * 100, cm[1][1]/Pos_num * 100))
-    
-    return Auc, Acc
-
-
-def get_auc(ture, pred):
-    fpr, tpr, thresholds = metrics.roc_curve(ture, pred, pos_label=1)
-    return metrics.auc(fpr, tpr)
-
-
-def save_roc(ture, pred, imgn):
-    fpr, tpr, thresholds = metrics.roc_curve(ture, pred, pos_label=1)
-    plt.cla()
-    plt.plot(fpr,tpr)
-    plt.savefig(f'{imgn}.jpg')
-    return
-
-
 def get_parser():
     parser = argparse.ArgumentParser(description='PyTorch Implementation of multiple Instance learning')
     parser.add_argument('--mag', default='10', type=str)
@@ -419,6 +161,20 @@ def get_parser():
     parser.add_argument('--epo', default='5', type=str)
     parser.add_argument('--model', default='inceptionv3', type=str)
     parser.add_argument('--extd', default=7, type=int)
+    parser.add_argument('--manifest', default='./manifest/', type=str, help='slide/tile manifest cache directory')
+    parser.add_argument('--nb_engine', default='sklearn', type=str, help='neighbour engine for clusters: sklearn or grid')
+    parser.add_argument('--shards', default=None, type=str, help='root of packed tile shards (see pack_shards.py)')
+    parser.add_argument('--tile_cache', default=None, type=str, help='directory of the memory-mapped cache of transformed evaluation tiles')
+    parser.add_argument('--draft_tolerance', default=1.0, type=float, help='decode JPEG tiles at 1/2-1/8 scale when the first Resize then upsamples by at most this factor (1.0: lossless only)')
+    parser.add_argument('--index_workers', default=1, type=int, help='processes used to index slides')
+    parser.add_argument('--shard', default='balanced', choices=['balanced', 'stride'], help="split of evaluation slides over ranks: 'balanced' assigns every slide once by estimated cost, 'stride' is the legacy split that drops len % world_size slides")
+    parser.add_argument('--bags_per_step', default=1, type=int, help='test slides packed into one forward pass')
+    parser.add_argument('--stream_clusters', default=0, type=int, help='evaluate every cluster of each slide, this many clusters per forward pass, with the slide attention accumulated across passes (0: a random sample of 50 clusters per slide)')
+    parser.add_argument('--embedding_store', default=None, type=str, help='directory of the persistent store of backbone embeddings, reused by checkpoints with unchanged backbone weights and by later runs')
+    parser.add_argument('--embedding_store_gb', default=None, type=float, help='size bound of the embedding store; least recently used slides are evicted beyond it')
+    parser.add_argument('--precision', default='fp32', choices=sorted(PRECISIONS), help="'bf16' runs the backbone and cluster encoder under bfloat16 autocast; the slide attention and Y_prob stay fp32")
+    parser.add_argument('--channels_last', action='store_true', help='keep the backbone weights and tiles in channels-last memory format')
+    parser.add_argument('--profile', action='store_true', help='print the FLOPs and parameter count of the backbone (needs thop)')
     parser.add_argument('--local_rank', type=int, default=0)
     parser.add_argument('--init_method', type=str)
     return parser.parse_args()
@@ -433,6 +189,7 @@ if __name__ == '__main__':
     save_file = datetime.datetime.strftime(datetime.datetime.now(),'%Y-%m-%d-%H-%M-%S')
     os.mkdir(f'./{save_file}_{args.model_id}_X{args.mag}/')
         
+    import pandas as pd
     pat_slide_all = pd.read_excel('pat_slide_all.xlsx')
     test_path = {
         'train': '../train/',
@@ -440,21 +197,27 @@ if __name__ == '__main__':
         'test': '../test/'
                 }
         
-    torch.backends.cudnn.benchmark = True
-    torch.cuda.set_device(args.local_rank)
+    if torch.cuda.is_available():
+        torch.backends.cudnn.benchmark = True
+        torch.cuda.set_device(args.local_rank)
     torch.distributed.init_process_group(
-        'nccl',
+        'nccl' if torch.cuda.is_available() else 'gloo',
         init_method=args.init_method
-    ) 
+    )
     
-    device = torch.device(f"cuda:{args.local_rank}")
+    device = torch.device(f"cuda:{args.local_rank}") if torch.cuda.is_available() else torch.device('cpu')
  
-    model = apex.parallel.convert_syncbn_model(
-        Attention_Gated(args.model, True, extd=args.extd)
-    ).to(device)
-    
-    model = amp.initialize(model,opt_level="O0", keep_batchnorm_fp32=None)
-    model = DistributedDataParallel(model, delay_allreduce=True)
+    model = Attention_Gated(args.model, extd=args.extd, lazy=True, profile=args.profile and args.local_rank == 0)
+    if device.type == 'cuda':
+        import apex
+        from apex import amp
+        from apex.parallel import DistributedDataParallel
+        model = apex.parallel.convert_syncbn_model(model).to(device, memory_format=memory_format(args))
+        model = amp.initialize(model,opt_level="O0", keep_batchnorm_fp32=None)
+        model = DistributedDataParallel(model, delay_allreduce=True)
+    else:
+        # Ranks evaluate different numbers of bags: no collective per forward.
+        model = torch.nn.parallel.DistributedDataParallel(model.to(memory_format=memory_format(args)), broadcast_buffers=False)
 
     # option = 'train'
     option = 'valid'
@@ -543,11 +306,16 @@ if __name__ == '__main__':
                                       ]),
                                   limit=2,
                                   shuffle=False,
-                                  extd=args.extd)
-
-        memory_format = torch.contiguous_format
-        collate_fn = lambda b: fast_collate(b, memory_format)
-        sampler = TestDistSlideSampler(eval_datasets, limit=50)
+                                  extd=args.extd,
+                                  manifest=args.manifest,
+                                  nb_engine=args.nb_engine,
+                                  reader=get_reader(test_path[option], args.shards),
+                                  tile_cache=args.tile_cache,
+                                  draft_tolerance=args.draft_tolerance,
+                                  workers=args.index_workers)
+
+        collate_fn = unique_collate
+        sampler = TestDistSlideSampler(eval_datasets, limit=50, balance=args.shard == 'balanced', bags=args.bags_per_step, chunk=args.stream_clusters)
         eval_loader = DL(eval_datasets, 
                          batch_sampler=sampler,
                          num_workers=16,
@@ -573,18 +341,23 @@ if __name__ == '__main__':
         for epoch in range(1, epomax):
             epo = str(epoch)
 
-            model.load_state_dict(torch.load(f'./checkpoints_{mg}X_{args.model_id}_F{fd}/comment/{epo}.pt'))
+            model.load_state_dict(torch.load(f'./checkpoints_{mg}X_{args.model_id}_F{fd}/comment/{epo}.pt', map_location=device))
             print(f'Testing: Mag-{mg}X-Epo{epo}')
             print(f'Model: {option}-X{mg}-{args.model_id}-{epo}')
             print('-'*30)
 
-            all_labels, all_values = eval_model(args, eval_loader, model)
+            store = None
+            if args.embedding_store:
+                max_bytes = int(args.embedding_store_gb * 2**30) if args.embedding_store_gb else None
+                store = EmbeddingStore(args.embedding_store, model.module.feature_extractor, eval_datasets, test_path[option], args.mag, width=model.module.L, max_bytes=max_bytes, precision=args.precision)
+            eval_datasets.store = store
+            evaluate = stream_model if args.stream_clusters else eval_model
+            all_labels, all_values, positions = evaluate(args, eval_loader, model, device, store)
             if args.local_rank == 0:
-                import pandas as pd
                 result = pd.DataFrame({
-                    'Pat':[p.split('-')[-1] for p in eval_datasets.slide[:,0]],
-                    'tile_id':eval_datasets.slide[:,0],
-                    'Slide':eval_datasets.slide[:,1],
+                    'Pat':[p.split('-')[-1] for p in eval_datasets.slide[positions,0]],
+                    'tile_id':eval_datasets.slide[positions,0],
+                    'Slide':eval_datasets.slide[positions,1],
                     'Label':all_labels,
                     'Value':all_values
                 })
@@ -614,6 +387,7 @@ if __name__ == '__main__':
                 save_roc(all_labels, all_values, 'Slide_level')
                 save_roc(result_max['Label'], result_max['Value'], 'Pat_level')
 
+                from scipy import stats
                 print('Slide prediction mean:', round(np.mean(all_values),4))
                 print('Slide prediction median:', round(np.median(all_values),4))
                 n, min_max, mean, var, skew, kurt = stats.describe(all_values)
@@ -2,66 +2,27 @@ from __future__ import print_function
 import numpy as np
 import argparse
 import torch
-import torch.nn as nn
-import torch.utils.data as data_utils
 import torch.optim as optim
-from warmup_scheduler import GradualWarmupScheduler
 import json
-from torch.autograd import Variable
-from torchvision import models, transforms
-import torch.nn.functional as F
-from tensorboardX import SummaryWriter
-from sklearn.metrics import roc_curve, auc, confusion_matrix
-from sklearn.neighbors import NearestNeighbors
-from sklearn import metrics
+from torchvision import transforms
 import os
-import time
-import apex
-from apex import amp
-from apex.fp16_utils import *
-from apex.parallel import DistributedDataParallel
-from apex.multi_tensor_apply import multi_tensor_applier
-from torch.utils.data import Dataset, DataLoader as DL, Sampler
-from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data import Dataset, DataLoader as DL
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from PIL import Image 
-import glob
-import torch.distributed as dist
-import torchvision
-import pretrainedmodels
 import random
-import pandas as pd
-import copy
-import datetime
-from thop import profile
-from scipy import stats
 import math
 import warnings
-warnings.filterwarnings("ignore")
+import functools
+from slide_index import index_slides, compact_index
+from augment import BagAugment
+from tile_io import get_reader, TileCache, DraftDecode, is_deterministic, transform_key
+from mil_ops import segment_ids, segment_starts
+from mil_model import Attention_Gated, reduce_tensor, gather_tensor, gather_ordered, get_cm
+from embeddings import EmbeddingBags, embedding_collate, extract_embeddings, weights_key
+from bag_loader import Bag, load_bag, expand, PinnedRing, stable_seed, seed_worker, data_prefetcher, DistSlideSampler, TestDistSlideSampler, fast_collate
 
 
 
-def get_loc(img_name):
-    return np.array(list(map(int,img_name.split('/')[-1].split('.')[0].split('_'))))
-
-
-def resampling(list_0, num):
-    list_1 = copy.deepcopy(list_0)
-    list_2 = copy.deepcopy(list_0)
-    times = num // len(list_2)
-    if times > 1:
-        list_2.extend((times-1)*list_1)
-    random.seed(36)
-    list_2.extend(random.sample(list_2,num-len(list_2)))
-    return list_2
-
-
-def random_del(neb_list):
-    seed = random.randint(0,len(neb_list)-1)
-    neb_list.pop(seed)
-    return neb_list
-
-
 def channel_shuffle_fn(img):
     img = np.array(img, dtype=np.uint8)
     channel_idx = list(range(img.shape[-1]))
@@ -72,326 +33,99 @@ def channel_shuffle_fn(img):
 
 
 class CC_Dataset(Dataset):
-    def __init__(self, Data_path, ptids, Mag='5', transforms=None, limit=96, shuffle=False, extd=7):
+    def __init__(self, Data_path, ptids, Mag='5', transforms=None, limit=96, shuffle=False, extd=7, manifest='./manifest/', nb_engine='sklearn', reader=None, tile_cache=None, draft_tolerance=1.0, workers=1):
         self.ptids = ptids
-        self.slide = [
-            (ptid, slide) 
-            for ptid in ptids
-            for slide in os.listdir(os.path.join(Data_path, ptid))
-            if limit <= len(glob.glob(os.path.join(Data_path, ptid, slide, Mag, '*')))
-        ]
-        
-        index = 0
-        self.patch = []
-        self.label = []
-        self.indices = {}
-        for i, (ptid, slide) in enumerate(self.slide):
-            patches_t = glob.glob(os.path.join(Data_path, ptid, slide, Mag, '*'))
-            patches_a = glob.glob(os.path.join(Data_path, ptid, slide, Mag.split('_')[0], '*'))
-            
-            if len(patches_a) < extd+1:
-                patches_a = resampling(patches_a, extd+1)
-            
-            self.patch.extend(patches_t)
-            self.patch.extend(patches_a)
-            
-            label = data_map[ptid]['patient-label']
-            
-            self.label.extend([label]*len(patches_t))
-            self.label.extend([label]*len(patches_a))
-            
-            range_t = np.arange(index, index+len(patches_t))
-            index += len(patches_t)
-            range_a = np.arange(index, index+len(patches_a))
-            index += len(patches_a)
-            
-            nbs = NearestNeighbors(extd+1).fit(list(map(get_loc, patches_a)))
-            
-            self.indices[(ptid, slide)] = []
-            for i in range(len(patches_t)):
-                nb_list = list(nbs.kneighbors(get_loc(patches_t[i]).reshape(1,-1),
-                                              return_distance=False)[0])[1:]
-                for e in range(len(nb_list)-extd):
-                    random.seed(666*i+e)
-                    nb_list = random_del(nb_list)
-                inx = []
-                for nl in nb_list:
-                    inx.append(range_a[nl])
-                self.indices[(ptid, slide)].append([range_t[i]]+inx)
-
+        slides = index_slides(Data_path, ptids, Mag, extd, data_map, limit=limit, manifest_dir=manifest, engine=nb_engine, workers=workers)
+        self.slide = [(ptid, slide) for ptid, slide, _ in slides]
+        self.patch, self.label, self.indices = compact_index(slides)
         self.slide = np.array(self.slide)
-        self.data_transforms = transforms
+        self.data_transforms = DraftDecode(transforms, draft_tolerance) if transforms is not None else None
+        self.shared = is_deterministic(transforms)
+        self.reader = reader if reader is not None else get_reader(Data_path)
+        self.cache = None
+        if tile_cache and len(self.patch):
+            shape = np.asarray(self.data_transforms(self.reader.open(self.patch[0]))).shape
+            self.cache = TileCache(tile_cache, self.data_transforms, Data_path, Mag, slides, self.label.offsets, shape)
         
     def __len__(self):
         return len(self.patch)
     
     def __getitem__(self, index):
-        img = Image.open(self.patch[index])
+        if self.cache is not None:
+            return self.cache.get(index, self.patch[index], self.reader), self.label[index]
+        img = self.reader.open(self.patch[index])
         label = self.label[index]
         if self.data_transforms is not None:
             img = self.data_transforms(img)
         return img, label
-    
-    
-class DistSlideSampler(DistributedSampler):
-    def __init__(self, dataset, padding, seed, shuffle=False):
-        super(DistSlideSampler, self).__init__(dataset)
-        self.slide = dataset.slide
-        self.indices = dataset.indices
-        self.padding = padding
-        self.seed = hash(seed)
-        self.g = torch.Generator()
-        
-    def __iter__(self):
-        self.g.manual_seed(self.seed + self.epoch)
-        indices = torch.randperm(
-            len(self.slide) - len(self.slide)%self.num_replicas, 
-            generator=self.g
-        ).tolist()
-        for i in indices[self.rank::self.num_replicas]:
-            ptid, slide = self.slide[i]
-            yield self.get_slide(ptid, slide)
-        
-    def __len__(self):
-        return len(self.slide) // self.num_replicas
-    
-    def get_slide(self, ptid, slide):
-        indice = self.indices[(ptid, slide)]
-        patch_num = len(indice)
-        np.random.seed(self.seed % (2**32) + self.epoch)
-        if patch_num <= self.padding:
-            indice = resampling(indice, self.padding)
-            return np.array(indice).flatten()
-        else:
-            random.seed(time.time()*1000000)
-            indice = random.sample(indice, self.padding)
-            return np.array(indice).flatten()
-        
-    
-class TestDistSlideSampler(DistributedSampler):
-    def __init__(self, dataset, limit=512, shuffle=False):
-        super(TestDistSlideSampler, self).__init__(dataset)
-        self.slide = dataset.slide
-        self.indices = dataset.indices
-        self.limit = limit
-        
-    def __len__(self):
-        return len(self.slide) // self.num_replicas
-    
-    def __iter__(self):
-        slide = self.slide[len(self.slide)%self.num_replicas:]
-        for ptid, slide in slide[self.rank::self.num_replicas]:
-            yield self.get_slide(ptid, slide)
-            
-    def get_slide(self, ptid, slide):
-        indice = self.indices[(ptid, slide)]
-        patch_num = len(indice)
-        if patch_num > self.limit:
-            random.seed(666)
-            indice = random.sample(indice, self.limit)
-            random.seed(time.time()*1000000)
-            return np.array(indice).flatten()
-        else:
-            return np.array(indice).flatten()
-    
-
-def fast_collate(batch, memory_format):
-    imgs = [img[0] for img in batch]
-    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
-    w, h = imgs[0].size[0], imgs[0].size[1]
-    tensor = torch.zeros((len(imgs), 3, h, w), dtype=torch.uint8).contiguous(memory_format=memory_format)
-    for i, img in enumerate(imgs):
-        numpy_array = np.asarray(img, dtype=np.uint8)
-        numpy_array = np.rollaxis(numpy_array, 2)
-        tensor[i] += torch.from_numpy(numpy_array.copy())
-    return tensor, targets
 
+    def __getitems__(self, indices):
+        if self.shared:
+            bag = load_bag(indices, self.__getitem__)
+        else:
+            imgs = load_bag(indices, lambda i: self.reader.open(self.patch[i]))
+            bag = Bag([(self.data_transforms(img), self.label[i]) for i, img in zip(indices, expand(imgs, imgs.inverse))], None)
+        bag.segments = segment_ids(self.label.offsets, indices)
+        return bag
 
-def prepare_dataset(data_path, padding=128, mag='5', seed='None', extd=7, test_limit=64):
+    
+def prepare_dataset(data_path, padding=128, mag='5', seed='None', extd=7, test_limit=64, manifest='./manifest/', nb_engine='sklearn', index_workers=1, shards=None, tile_cache=None, draft_tolerance=1.0, workers=0, prefetch=2, shard='balanced', bags=1, eval_bags=1):
     limit = 1
+    reader = get_reader(data_path, shards)
     train_datasets = CC_Dataset(data_path, 
-                                train_label, 
+                                KF_all_id, 
                                 limit=limit, 
                                 Mag=mag,  
                                 transforms=train_transform,
                                 shuffle=False,
-                                extd=extd)
+                                extd=extd,
+                                manifest=manifest,
+                                nb_engine=nb_engine,
+                                workers=index_workers,
+                                reader=reader,
+                                draft_tolerance=draft_tolerance)
     val_datasets = CC_Dataset(data_path,  
-                              val_label, 
+                              KF_all_id, 
                               limit=limit, 
                               Mag=mag, 
                               transforms=test_transform,
                               shuffle=False,
-                              extd=extd)
+                              extd=extd,
+                              manifest=manifest,
+                              nb_engine=nb_engine,
+                              workers=index_workers,
+                              reader=reader,
+                              tile_cache=tile_cache,
+                              draft_tolerance=draft_tolerance)
     
     if args.local_rank == 0:
-        print('Train slide number:', len(train_datasets.slide))
-        print('Train patches number:', len(train_datasets))
-        print('Valid slide number:', len(val_datasets.slide))
-        print('Valid patches number:', len(val_datasets))
+        print('Slide number:', len(train_datasets.slide))
+        print('Patches number:', len(train_datasets))
         
-    memory_format = torch.contiguous_format
-    collate_fn = lambda b: fast_collate(b, memory_format)
+    loader_args = dict(num_workers=workers, pin_memory=True, worker_init_fn=seed_worker)
+    if workers > 0:
+        loader_args.update(persistent_workers=True, prefetch_factor=prefetch)
+    rank = torch.distributed.get_rank()
     
     train_loader = DL(train_datasets, 
                       batch_sampler=DistSlideSampler(train_datasets, 
                                                      padding=padding, 
-                                                     seed=seed),
-                      num_workers=0,
-                      pin_memory=True,
-                      collate_fn=collate_fn,
-                      shuffle=False)
+                                                     seed=seed,
+                                                     bags=bags),
+                      collate_fn=functools.partial(fast_collate, ring=None if workers else PinnedRing()),
+                      generator=torch.Generator().manual_seed(stable_seed(seed) + 2*rank),
+                      **loader_args)
     val_loader = DL(val_datasets, 
                     batch_sampler=TestDistSlideSampler(val_datasets, 
-                                                       limit=test_limit),
-                    num_workers=0,
-                    pin_memory=True,
-                    collate_fn=collate_fn,
-                    shuffle=False)
-    return train_loader, val_loader, val_datasets.slide
-
-
-class data_prefetcher():
-    def __init__(self, loader, dataset='train'):
-        self.loader = iter(loader)
-        self.stream = torch.cuda.Stream()
-        if dataset=='test2____':
-            self.mean = torch.tensor([179.39, 105.45, 168.53]).cuda().view(1,3,1,1)
-            self.std = torch.tensor([25.39, 31.86, 19.66]).cuda().view(1,3,1,1)
-        else:
-            self.mean = torch.tensor([165.65, 100.58, 156.62]).cuda().view(1,3,1,1)
-            self.std = torch.tensor([27.72, 28.29, 19.74]).cuda().view(1,3,1,1)
-        self.preload()
-
-    def preload(self):
-        try:
-            self.next_input, self.next_target = next(self.loader)
-        except StopIteration:
-            self.next_input = None
-            self.next_target = None
-            return
-        with torch.cuda.stream(self.stream):
-            self.next_input = self.next_input.cuda(non_blocking=True)
-            self.next_target = self.next_target.cuda(non_blocking=True)
-            self.next_input = self.next_input.float()
-            self.next_input = self.next_input.sub_(self.mean).div_(self.std)
-
-    def next(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        input = self.next_input
-        target = self.next_target
-        if input is not None:
-            input.record_stream(torch.cuda.current_stream())
-        if target is not None:
-            target.record_stream(torch.cuda.current_stream())
-        self.preload()
-        return input, target
-    
+                                                       limit=test_limit,
+                                                       balance=shard == 'balanced',
+                                                       bags=eval_bags),
+                    collate_fn=functools.partial(fast_collate, ring=None if workers else PinnedRing()),
+                    generator=torch.Generator().manual_seed(stable_seed(seed) + 2*rank + 1),
+                    **loader_args)
+    return train_loader, val_loader
+
 
-class Attention_Gated(nn.Module):
-    def __init__(self, model, pretrain, extd=7):
-        super(Attention_Gated, self).__init__()
-        self.extd = extd
-        self.L = 512
-        self.D = 128
-        self.K = 1
-        
-        if model == 'alexnet':
-            self.feature_extractor = torchvision.models.alexnet(pretrained=False)
-            self.feature_extractor.classifier = nn.Linear(9216, self.L)
-            if args.local_rank == 0:
-                input_test = torch.randn(1, 3, 224, 224)
-                flops, params = profile(self.feature_extractor, inputs=(input_test, ))
-                print('FLOPS:', flops)
-                print('PARAMS:', params)
-            nn.init.xavier_normal_(self.feature_extractor.classifier.weight)
-        elif model == 'vgg11':
-            self.feature_extractor = torchvision.models.vgg11(pretrained=False)
-            self.feature_extractor.classifier = nn.Linear(25088, self.L)
-            if args.local_rank == 0:
-                input_test = torch.randn(1, 3, 224, 224)
-                flops, params = profile(self.feature_extractor, inputs=(input_test, ))
-                print('FLOPS:', flops)
-                print('PARAMS:', params)
-            nn.init.xavier_normal_(self.feature_extractor.classifier.weight)
-        elif model == 'resnet50':
-            self.feature_extractor = torchvision.models.resnet50(pretrained=True)
-            self.feature_extractor.fc = nn.Linear(2048, self.L)
-            if args.local_rank == 0:
-                input_test = torch.randn(1, 3, 224, 224)
-                flops, params = profile(self.feature_extractor, inputs=(input_test, ))
-                print('FLOPS:', flops)
-                print('PARAMS:', params)
-            nn.init.xavier_normal_(self.feature_extractor.fc.weight)
-        elif model == 'densenet121':
-            self.feature_extractor = torchvision.models.densenet121(pretrained=False)
-            self.feature_extractor.classifier = nn.Linear(1024, self.L)
-            if args.local_rank == 0:
-                input_test = torch.randn(1, 3, 224, 224)
-                flops, params = profile(self.feature_extractor, inputs=(input_test, ))
-                print('FLOPS:', flops)
-                print('PARAMS:', params)
-            nn.init.xavier_normal_(self.feature_extractor.classifier.weight)
-        elif model == 'squeezenet1_0':
-            self.feature_extractor = torchvision.models.squeezenet1_0(pretrained=False)
-            print(self.feature_extractor)
-            self.feature_extractor.classifier = nn.Linear(512, self.L)
-            if args.local_rank == 0:
-                input_test = torch.randn(1, 3, 224, 224)
-                flops, params = profile(self.feature_extractor, inputs=(input_test, ))
-                print('FLOPS:', flops)
-                print('PARAMS:', params)
-            nn.init.xavier_normal_(self.feature_extractor.classifier.weight)
-        else:
-            self.feature_extractor = torchvision.models.inception_v3(pretrained=True, aux_logits=False)
-            self.feature_extractor.fc = nn.Linear(2048, self.L)
-            if args.local_rank == 0:
-                input_test = torch.randn(1, 3, 224, 224)
-                flops, params = profile(self.feature_extractor, inputs=(input_test, ))
-                print('FLOPS:', flops)
-                print('PARAMS:', params)
-            nn.init.xavier_normal_(self.feature_extractor.fc.weight)
-            
-        self.encoder = nn.TransformerEncoder(
-            nn.TransformerEncoderLayer(d_model=self.L, 
-                                       nhead=8,
-                                       activation='gelu'),
-            num_layers=2,
-            norm=nn.LayerNorm(normalized_shape=self.L, eps=1e-6)
-        )
-        
-        self.inner_attention = nn.Linear(self.L, self.K)
-        nn.init.xavier_normal_(self.inner_attention.weight)
-        
-        self.attention = nn.Linear(self.L, self.K)
-        nn.init.xavier_normal_(self.attention.weight)
-        
-        self.classifier = nn.Sequential(
-            nn.Linear(self.L*self.K, 1),
-            nn.Sigmoid()
-        )
-        nn.init.xavier_normal_(self.classifier[0].weight)
-        
-    
-    def forward(self, x):
-        x = x.squeeze(0)
-        H = self.feature_extractor(x)
-        H = H.view((-1, self.extd+1, self.L))
-        H = self.encoder(H.transpose(0,1))
-        H = H.transpose(0,1)
-        
-        H = torch.cat([torch.mm(F.softmax(self.inner_attention(h).transpose(0,1), dim=1), h) for h in H], 0)
-        
-        A = self.attention(H)
-        A = torch.transpose(A, 1, 0)
-        A = F.softmax(A, dim=1)
-        
-        M = torch.mm(A, H)
-        Y_prob = self.classifier(M)
-        
-        return Y_prob
-    
-    
 def run(args, train_loader, val_loader, model, epochs, schduler, optimizer, device, Writer, val_slide_info):
     
     best_auc = .0
@@ -410,6 +144,7 @@ def run(args, train_loader, val_loader, model, epochs, schduler, optimizer, devi
         all_labels, all_values = eval_model(args, val_loader, model, device, optimizer, epoch, Writer, '2-Valid')
         
         if args.local_rank == 0:
+            from scipy import stats
             print('Slide prediction mean:', round(np.mean(all_values),4))
             print('Slide prediction median:', round(np.median(all_values),4))
             n, min_max, mean, var, skew, kurt = stats.describe(all_values)
@@ -418,31 +153,14 @@ def run(args, train_loader, val_loader, model, epochs, schduler, optimizer, devi
             print('Slide prediction 0.95 CI:', '['+str(round(CI[0], 4))+', '+str(round(CI[1], 4))+']')
     
             
-def reduce_tensor(tensor: torch.Tensor) -> torch.Tensor:
-    rt = tensor.clone()
-    torch.distributed.all_reduce(rt, op=torch.distributed.ReduceOp.SUM)
-    return rt
-
-
-def gather_tensor(tensor: torch.Tensor):
-    rt = tensor.clone()
-    var_list = [torch.zeros_like(rt) for _ in range(torch.distributed.get_world_size())]
-    torch.distributed.all_gather(var_list, rt, async_op=False)
-    return [i.item() for i in var_list]
-
-
 def set_fn(v):
+    import apex
     def f(m):
         if isinstance(m, apex.parallel.SyncBatchNorm):
             m.momentum = v
     return f
 
 
-def get_auc(ture, pred):
-    fpr, tpr, thresholds = metrics.roc_curve(ture, pred, pos_label=1)
-    return metrics.auc(fpr, tpr)
-
-
 def train_model(args, train_loader, model, device, optimizer, epoch, Writer):
     phase = '1-Train'
     model.train()
@@ -452,34 +170,39 @@ def train_model(args, train_loader, model, device, optimizer, epoch, Writer):
     train_loss = 0
     index = 0
     
-    prefetcher = data_prefetcher(train_loader)
-    patches, label = prefetcher.next()
-    while patches is not None:
-        index += 1
-        label = label[0]
-        Y_prob= model.forward(patches)
-        Y_prob = torch.clamp(Y_prob, min=1e-5, max=1.-1e-5)
-
-        J = -1.*(
-            label*torch.log(Y_prob)+
-            (1.-label)*torch.log(1.-Y_prob)
-        )
+    with data_prefetcher(train_loader, transform=BagAugment() if args.augment == 'tensor' and not args.embeddings else None, width=3) as prefetcher:
+        patches, label, segments = prefetcher.next()
+        while patches is not None:
+            index += 1
+            label = label[segment_starts(segments)].float().view(-1, 1)
+            Y_prob= model.forward(patches, segments)
+            Y_prob = torch.clamp(Y_prob, min=1e-5, max=1.-1e-5)
+
+            J = -1.*(
+                label*torch.log(Y_prob)+
+                (1.-label)*torch.log(1.-Y_prob)
+            )
         
-        optimizer.zero_grad()
-        with amp.scale_loss(J, optimizer) as scale_loss:
-            scale_loss.backward()
-        optimizer.step()
+            optimizer.zero_grad()
+            if device.type == 'cuda':
+                from apex import amp
+                with amp.scale_loss(J.mean(), optimizer) as scale_loss:
+                    scale_loss.backward()
+            else:
+                J.mean().backward()
+            optimizer.step()
 
-        reduced_loss = reduce_tensor(J.data)
-        train_loss += reduced_loss.item()
+            reduced_loss = reduce_tensor(J.data.sum())
+            train_loss += reduced_loss.item()
         
-        all_labels.extend(gather_tensor(label))
-        all_values.extend(gather_tensor(Y_prob[0][0]))
+            all_labels.extend(gather_tensor(label))
+            all_values.extend(gather_tensor(Y_prob[:, 0]))
         
-        patches, label = prefetcher.next()
+            patches, label, segments = prefetcher.next()
         
     if args.local_rank == 0:
         print(len(all_labels))
+        print(train_loader.batch_sampler.counter)
         all_labels = np.array(all_labels)
         Loss = train_loss / len(all_labels)
         AUC, Acc = get_cm(all_labels, all_values)
@@ -492,34 +215,35 @@ def eval_model(args, dataloader, model, device, optimizer, epoch, Writer, phase)
     all_labels = []
     all_values = []
     all_names = []
-    train_loss = 0
+    all_losses = []
     
-    prefetcher = data_prefetcher(dataloader, dataset=phase)
-    patches, label = prefetcher.next()
-    index = 0
-    while patches is not None:
-        index += 1
-        label = label[0].float()
-        
-        with torch.no_grad():
-            Y_prob= model.forward(patches)
-            Y_prob = torch.clamp(Y_prob, min=1e-5, max=1. - 1e-5)
-
-            J = -1.*(
-                label*torch.log(Y_prob)+
-                (1.-label)*torch.log(1.-Y_prob)
-            )
+    with data_prefetcher(dataloader, width=3) as prefetcher:
+        patches, label, segments = prefetcher.next()
+        index = 0
+        while patches is not None:
+            index += 1
+            label = label[segment_starts(segments)].float().view(-1, 1)
         
-        reduced_loss = reduce_tensor(J.data)
+            with torch.no_grad():
+                Y_prob= model.forward(patches, segments)
+                Y_prob = torch.clamp(Y_prob, min=1e-5, max=1. - 1e-5)
+
+                J = -1.*(
+                    label*torch.log(Y_prob)+
+                    (1.-label)*torch.log(1.-Y_prob)
+                )
         
-        train_loss += reduced_loss.item()
-        all_labels.extend(gather_tensor(label))
-        all_values.extend(gather_tensor(Y_prob[0][0]))
+            all_losses.extend(J.view(-1).tolist())
+            all_labels.extend(label.view(-1).tolist())
+            all_values.extend(Y_prob[:, 0].tolist())
         
-        patches, label = prefetcher.next()
+            patches, label, segments = prefetcher.next()
             
+    positions, all_labels, all_values, all_losses = gather_ordered(dataloader.batch_sampler.positions, all_labels, all_values, all_losses)
+    train_loss = sum(all_losses)
     if args.local_rank == 0:
         print(len(all_labels))
+        print(dataloader.batch_sampler.counter)
         all_labels = np.array(all_labels)
         Loss = train_loss / len(all_labels)
         AUC, Acc = get_cm(all_labels, all_values)
@@ -527,28 +251,6 @@ def eval_model(args, dataloader, model, device, optimizer, epoch, Writer, phase)
     return all_labels, all_values
 
     
-def get_cm(AllLabels, AllValues):
-    fpr, tpr, threshold = roc_curve(AllLabels, AllValues, pos_label=1)
-    Auc = auc(fpr, tpr)
-    m = t = 0
-
-    for i in range(len(threshold)):
-        if tpr[i] - fpr[i] > m :
-            m = abs(-fpr[i]+tpr[i])
-            t = threshold[i]
-    AllPred = [int(i>=t) for i in AllValues]
-    Acc = sum([AllLabels[i] == AllPred[i] for i in range(len(AllPred))]) / len(AllPred)
-
-    Pos_num = sum(AllLabels)
-    Neg_num = len(AllLabels) - Pos_num
-    cm = confusion_matrix(AllLabels, AllPred)
-    print("[AUC/{:.4f}] [Threshold/{:.4f}] [Acc/{:.4f}]".format(Auc, t,  Acc))
-    print("{:.2f}% {:.2f}%".format(cm[0][0]/ Neg_num * 100, cm[0][1]/Neg_num * 100))
-    print("{:.2f}% {:.2f}%".format(cm[1][0]/ Pos_num * 100, cm[1][1]/Pos_num * 100))
-    
-    return Auc, Acc
-
-
 def get_parser():
     parser = argparse.ArgumentParser(description='PyTorch Implementation of multiple Instance learning')
     parser.add_argument('--path', default='/data_path/', type=str, help='path of patches')
@@ -566,6 +268,23 @@ def get_parser():
     parser.add_argument('--comment', default='comment', type=str)
     parser.add_argument('--model', default='inceptionv3', type=str)
     parser.add_argument('--pretrain', action='store_true')
+    parser.add_argument('--manifest', default='./manifest/', type=str, help='slide/tile manifest cache directory')
+    parser.add_argument('--nb_engine', default='sklearn', type=str, help='neighbour engine for clusters: sklearn or grid')
+    parser.add_argument('--shards', default=None, type=str, help='root of packed tile shards (see pack_shards.py)')
+    parser.add_argument('--tile_cache', default=None, type=str, help='directory of the memory-mapped cache of transformed evaluation tiles')
+    parser.add_argument('--draft_tolerance', default=1.0, type=float, help='decode JPEG tiles at 1/2-1/8 scale when the first Resize then upsamples by at most this factor (1.0: lossless only)')
+    parser.add_argument('--index_workers', default=1, type=int, help='processes used to index slides')
+    parser.add_argument('--shard', default='balanced', choices=['balanced', 'stride'], help="split of evaluation slides over ranks: 'balanced' assigns every slide once by estimated cost, 'stride' is the legacy split that drops len % world_size slides")
+    parser.add_argument('--bags_per_step', default=1, type=int, help='training slides packed into one forward pass; the loss is their mean')
+    parser.add_argument('--eval_bags_per_step', default=1, type=int, help='validation slides packed into one forward pass')
+    parser.add_argument('--embeddings', default=None, type=str, help='train only the heads on feature_extractor embeddings cached in this directory')
+    parser.add_argument('--backbone', default=None, type=str, help='checkpoint whose feature_extractor produces the cached embeddings (default: the freshly built one)')
+    parser.add_argument('--checkpoint_segments', default=0, type=int, help='recompute feature_extractor activations in backward, keeping only the boundaries of this many segments (0: keep all)')
+    parser.add_argument('--checkpoint_encoder', action='store_true', help='also recompute the transformer encoder layers in backward')
+    parser.add_argument('--workers', default=4, type=int, help='DataLoader workers per loader, kept alive across epochs and folds')
+    parser.add_argument('--prefetch', default=2, type=int, help='bags prefetched per DataLoader worker')
+    parser.add_argument('--profile', action='store_true', help='print the FLOPs and parameter count of the backbone (needs thop)')
+    parser.add_argument('--augment', default='pil', choices=['pil', 'tensor'], help='per-tile PIL transforms in the loader, or batched tensor augmentation on the device')
     parser.add_argument('--local_rank', type=int, default=0)
     parser.add_argument('--init_method', type=str)
     return parser.parse_args()
@@ -573,11 +292,13 @@ def get_parser():
 
 if __name__ == '__main__':
     args = get_parser()
+    warnings.filterwarnings("ignore")
     
     torch.backends.cudnn.benchmark = True
-    torch.cuda.set_device(args.local_rank)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(args.local_rank)
     torch.distributed.init_process_group(
-        'nccl',
+        'nccl' if torch.cuda.is_available() else 'gloo',
         init_method=args.init_method
     )
     name = args.comment
@@ -586,30 +307,76 @@ if __name__ == '__main__':
         data_map = json.load(f)
 
     data_path = args.path
-    KF_all_id= os.listdir(data_path)
+    KF_all_id = sorted(os.listdir(data_path))
     
     random.seed(int(args.model_id.split('_')[1]))
-    random.shuffle(all_id_list)
+    random.shuffle(KF_all_id)
+
+    train_transform = transforms.Compose([
+                transforms.RandomCrop(384),
+                transforms.Resize(299),
+                transforms.RandomResizedCrop(224, scale=(0.4, 1.0), ratio=(3. / 4., 4. / 3.)),
+                transforms.RandomHorizontalFlip(p=0.5),
+                channel_shuffle_fn,
+                transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4, hue=0.125),
+            ])
+    test_transform = transforms.Compose([
+                transforms.CenterCrop(384),
+                transforms.Resize(299),
+            ])
+    if args.augment == 'tensor':
+        train_transform = None
+
+    train_loader, val_loader = prepare_dataset(args.path, args.padding, args.mag, args.comment, args.extd, args.test_limit, args.manifest, args.nb_engine, args.index_workers, args.shards, args.tile_cache, args.draft_tolerance, args.workers, args.prefetch, args.shard, args.bags_per_step, args.eval_bags_per_step)
+    device = torch.device(f"cuda:{args.local_rank}") if torch.cuda.is_available() else torch.device('cpu')
+
+    if args.embeddings:
+        # Stage 1: every tile through the backbone once, with the evaluation
+        # transform. Stage 2 (the folds below) trains the heads on the cache.
+        net = Attention_Gated(args.model, extd=args.extd, lazy=bool(args.backbone), profile=args.profile and args.local_rank == 0)
+        if args.backbone:
+            state = torch.load(args.backbone, map_location='cpu')
+            net.load_state_dict({k[len('module.'):] if k.startswith('module.') else k: v for k, v in state.items()})
+        backbone = net.feature_extractor.to(device)
+        if not args.backbone:
+            # Every rank writes rows of the same file: extract with rank 0's
+            # freshly initialized weights.
+            for value in backbone.state_dict().values():
+                torch.distributed.broadcast(value, 0)
+        if args.local_rank == 0:
+            os.makedirs(args.embeddings, exist_ok=True)
+        # Keyed by the weights, not the checkpoint name: fold0/5.pt and
+        # fold1/5.pt, or two fresh initializations, never share a file.
+        path = os.path.join(args.embeddings, '{}-{}-{}.npy'.format(
+            args.model, weights_key(backbone), transform_key(test_transform, args.path, args.mag)))
+        embeddings = extract_embeddings(backbone, val_loader.dataset, path, net.L, val_loader.collate_fn, workers=args.workers, device=device)
+        del net, backbone
+        train_loader = DL(EmbeddingBags(embeddings, train_loader.dataset), batch_sampler=train_loader.batch_sampler, collate_fn=embedding_collate)
+        val_loader = DL(EmbeddingBags(embeddings, val_loader.dataset), batch_sampler=val_loader.batch_sampler, collate_fn=embedding_collate)
+    
+    # Only the code path in use pays for these imports.
+    if device.type == 'cuda':
+        import apex
+        from apex import amp
+        from apex.parallel import DistributedDataParallel
+    from warmup_scheduler import GradualWarmupScheduler
+    if args.local_rank == 0:
+        from tensorboardX import SummaryWriter
     
     for fd in range(5):
-        valid_label = KF_all_id[int(0.2*len(KF_all_id)*fd):int(0.2*len(KF_all_id)*(fd+1))]
-        train_label = list(set(KF_all_id)-set(valid_label))
+        val_label = KF_all_id[int(0.2*len(KF_all_id)*fd):int(0.2*len(KF_all_id)*(fd+1))]
+        train_label = list(set(KF_all_id)-set(val_label))
 
         train_label.sort()
         val_label.sort()
 
-        train_transform = transforms.Compose([
-                    transforms.RandomCrop(384),
-                    transforms.Resize(299),
-                    transforms.RandomResizedCrop(224, scale=(0.4, 1.0), ratio=(3. / 4., 4. / 3.)),
-                    transforms.RandomHorizontalFlip(p=0.5),
-                    channel_shuffle_fn,
-                    transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4, hue=0.125),
-                ])
-        test_transform = transforms.Compose([
-                    transforms.CenterCrop(384),
-                    transforms.Resize(299),
-                ])
+        train_loader.batch_sampler.set_slides(train_label)
+        val_loader.batch_sampler.set_slides(val_label)
+        val_slide_info = val_loader.batch_sampler.slide
+        if args.local_rank == 0:
+            print('Fold:', fd)
+            print('Train slide number:', len(train_loader.batch_sampler.slide))
+            print('Valid slide number:', len(val_slide_info))
 
         writer = 0
         if args.local_rank == 0:
@@ -634,18 +401,21 @@ if __name__ == '__main__':
                     pass
             ######################### Saving checkpoints and summary #########################
 
-        train_loader, val_loader, val_slide_info = prepare_dataset(args.path, args.padding, args.mag, args.comment, args.extd, args.test_limit)
-        device = torch.device(f"cuda:{args.local_rank}")
-        model = apex.parallel.convert_syncbn_model(
-            Attention_Gated(args.model, args.pretrain, args.extd)
-        ).to(device)
-
-        optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
-        model, optimizer = amp.initialize(model, optimizer, 
-                                          opt_level="O0",
-                                          keep_batchnorm_fp32=None)
-
-        model = DistributedDataParallel(model, delay_allreduce=True)
+        model = Attention_Gated(args.model, extd=args.extd, checkpoint_segments=args.checkpoint_segments, checkpoint_encoder=args.checkpoint_encoder, profile=args.profile and args.local_rank == 0)
+        if args.embeddings:
+            model.feature_extractor.requires_grad_(False)
+        if device.type == 'cuda':
+            model = apex.parallel.convert_syncbn_model(model)
+        model = model.to(device)
+        optimizer = optim.SGD([p for p in model.parameters() if p.requires_grad], lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+        if device.type == 'cuda':
+            model, optimizer = amp.initialize(model, optimizer, 
+                                              opt_level="O0",
+                                              keep_batchnorm_fp32=None)
+
+            model = DistributedDataParallel(model, delay_allreduce=True)
+        else:
+            model = torch.nn.parallel.DistributedDataParallel(model)
 
         scheduler = CosineAnnealingLR(optimizer, T_max=args.epochs-5, eta_min=1e-6)
         scheduler = GradualWarmupScheduler(optimizer, multiplier=1, total_epoch=5, after_scheduler=scheduler)
@@ -0,0 +1,146 @@
+from __future__ import print_function
+import math
+import torch
+import torch.nn.functional as F
+
+
+def rgb_to_grayscale(x):
+    return (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+
+def blend(x, y, ratio):
+    return (ratio * x + (1. - ratio) * y).clamp_(0., 1.)
+
+
+def rgb_to_hsv(x):
+    r, g, b = x.unbind(1)
+    maxc = x.max(1).values
+    cr = maxc - x.min(1).values
+    ones = torch.ones_like(maxc)
+    d = torch.where(cr > 0, cr, ones)
+    h = torch.where(maxc == r, (g - b) / d, torch.where(maxc == g, 2. + (b - r) / d, 4. + (r - g) / d))
+    h = torch.fmod(h / 6. + 1., 1.)
+    s = cr / torch.where(cr > 0, maxc, ones)
+    return torch.stack((h, s, maxc), 1)
+
+
+def hsv_to_rgb(x):
+    h, s, v = x.unbind(1)
+    n = torch.tensor([5., 3., 1.], device=x.device).view(1, 3, 1, 1)
+    k = torch.fmod(n + h.unsqueeze(1) * 6., 6.)
+    return v.unsqueeze(1) - (v * s).unsqueeze(1) * torch.minimum(k, 4. - k).clamp_(0., 1.)
+
+
+def adjust_brightness(x, factor):
+    return (x * factor).clamp_(0., 1.)
+
+
+def adjust_contrast(x, factor):
+    return blend(x, rgb_to_grayscale(x).mean(dim=(-3, -2, -1), keepdim=True), factor)
+
+
+def adjust_saturation(x, factor):
+    return blend(x, rgb_to_grayscale(x), factor)
+
+
+def adjust_hue(x, factor):
+    hsv = rgb_to_hsv(x)
+    hsv[:, 0] = torch.fmod(hsv[:, 0] + factor.view(-1, 1, 1) + 1., 1.)
+    return hsv_to_rgb(hsv)
+
+
+class BagAugment(object):
+    """Per-tile random augmentation of a collated uint8 (N, 3, H, W) bag.
+
+    Tensor counterpart of MILTrain's PIL train_transform: RandomCrop(crop),
+    Resize(resize), RandomResizedCrop(size, scale, ratio),
+    RandomHorizontalFlip, channel shuffle and ColorJitter. The crops are
+    resized together with antialiasing; the resized crop and the flip of
+    every tile are then folded into one affine_grid/grid_sample.
+    """
+    def __init__(self, crop=384, resize=299, size=224, scale=(0.4, 1.0), ratio=(3. / 4., 4. / 3.), flip=0.5,
+                 channel_shuffle=True, brightness=0.4, contrast=0.4, saturation=0.4, hue=0.125, chunk=64):
+        self.crop = crop
+        self.resize = resize
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.flip = flip
+        self.channel_shuffle = channel_shuffle
+        self.jitter = [
+            (adjust_brightness, (max(0., 1. - brightness), 1. + brightness)),
+            (adjust_contrast, (max(0., 1. - contrast), 1. + contrast)),
+            (adjust_saturation, (max(0., 1. - saturation), 1. + saturation)),
+            (adjust_hue, (-hue, hue)),
+        ]
+        self.chunk = chunk
+
+    def __repr__(self):
+        return '{}(crop={}, resize={}, size={}, scale={}, ratio={}, flip={}, channel_shuffle={})'.format(
+            self.__class__.__name__, self.crop, self.resize, self.size, self.scale, self.ratio, self.flip, self.channel_shuffle)
+
+    def resized_crop_boxes(self, n, device, attempts=10):
+        # torchvision RandomResizedCrop.get_params, all tiles and attempts at once.
+        side = float(self.resize)
+        area = side * side * torch.empty(n, attempts, device=device).uniform_(*self.scale)
+        log_ratio = torch.empty(n, attempts, device=device).uniform_(math.log(self.ratio[0]), math.log(self.ratio[1]))
+        aspect = torch.exp(log_ratio)
+        w = torch.sqrt(area * aspect).round()
+        h = torch.sqrt(area / aspect).round()
+        valid = (w > 0) & (w <= side) & (h > 0) & (h <= side)
+        first = valid.float().argmax(1, keepdim=True)
+        w = torch.where(valid.any(1), w.gather(1, first).squeeze(1), torch.full_like(w[:, 0], side))
+        h = torch.where(valid.any(1), h.gather(1, first).squeeze(1), torch.full_like(h[:, 0], side))
+        i = torch.floor(torch.rand(n, device=device) * (side - h + 1))
+        j = torch.floor(torch.rand(n, device=device) * (side - w + 1))
+        return i, j, h, w
+
+    def resize_bag(self, x):
+        size = (self.resize, self.resize)
+        if x.device.type == 'cpu':
+            try:
+                # uint8 channels_last is the fast antialiased path on CPU and
+                # rounds to uint8 like PIL's Resize.
+                x = x.contiguous(memory_format=torch.channels_last)
+                return F.interpolate(x, size=size, mode='bilinear', align_corners=False, antialias=True).float()
+            except RuntimeError:
+                pass
+        return F.interpolate(x.float(), size=size, mode='bilinear', align_corners=False, antialias=True)
+
+    def geometry(self, x):
+        n, _, H, W = x.shape
+        oy = torch.randint(0, H - self.crop + 1, (n,)).tolist()
+        ox = torch.randint(0, W - self.crop + 1, (n,)).tolist()
+        x = torch.stack([t[:, y:y+self.crop, z:z+self.crop] for t, y, z in zip(x, oy, ox)])
+        x = self.resize_bag(x)
+        i, j, h, w = self.resized_crop_boxes(n, x.device)
+        mirror = torch.where(torch.rand(n, device=x.device) < self.flip, -1., 1.)
+        theta = torch.zeros(n, 2, 3, device=x.device)
+        theta[:, 0, 0] = w / self.resize * mirror
+        theta[:, 0, 2] = (j + w / 2) / self.resize * 2 - 1
+        theta[:, 1, 1] = h / self.resize
+        theta[:, 1, 2] = (i + h / 2) / self.resize * 2 - 1
+        grid = F.affine_grid(theta, (n, 3, self.size, self.size), align_corners=False)
+        return F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+    def color(self, x):
+        n = x.shape[0]
+        if self.channel_shuffle:
+            perm = torch.rand(n, 3, device=x.device).argsort(1)
+            x = x.gather(1, perm[:, :, None, None].expand_as(x))
+        factors = [torch.empty(n, device=x.device).uniform_(*bounds) for _, bounds in self.jitter]
+        order = torch.rand(n, len(self.jitter), device=x.device).argsort(1)
+        for slot in range(len(self.jitter)):
+            for op, (fn, _) in enumerate(self.jitter):
+                idx = (order[:, slot] == op).nonzero().squeeze(1)
+                if len(idx):
+                    factor = factors[op][idx]
+                    x[idx] = fn(x[idx], factor if fn is adjust_hue else factor.view(-1, 1, 1, 1))
+        return x
+
+    def apply(self, x):
+        x = self.geometry(x).div_(255.).clamp_(0., 1.)
+        return self.color(x).mul_(255.).round_().to(torch.uint8)
+
+    def __call__(self, x):
+        return torch.cat([self.apply(c) for c in x.split(self.chunk)])
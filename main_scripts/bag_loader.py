@@ -0,0 +1,357 @@
+from __future__ import print_function
+import numpy as np
+import random
+import zlib
+import queue
+import threading
+import torch
+from torch.utils.data.distributed import DistributedSampler
+from slide_index import balance_shards
+
+
+TILE_MEAN = (165.65, 100.58, 156.62)
+TILE_STD = (27.72, 28.29, 19.74)
+
+
+def stable_seed(seed):
+    # hash() of a str is salted per process; workers and ranks must agree.
+    return zlib.crc32(str(seed).encode('utf-8'))
+
+
+def seed_worker(worker_id):
+    # torch seeds each worker's torch RNG; give random/numpy a matching
+    # per-worker seed so channel_shuffle_fn and numpy-based ops differ too.
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+class Bag(list):
+    """The distinct samples of a bag; bag[inverse] is the sampler's order.
+
+    indices, when known, are the dataset indices of the distinct samples.
+    """
+    def __init__(self, items, inverse, indices=None):
+        super(Bag, self).__init__(items)
+        self.inverse = inverse
+        self.indices = indices
+
+
+def load_bag(indices, load):
+    uniq, inverse = np.unique(np.asarray(indices), return_inverse=True)
+    return Bag([load(int(i)) for i in uniq], inverse.reshape(-1), uniq)
+
+
+def expand(items, inverse):
+    if inverse is None:
+        return items
+    return [items[i] for i in inverse]
+
+
+def empty_tiles(n, h, w):
+    numel = n * h * w * 3
+    if torch.utils.data.get_worker_info() is None:
+        return torch.empty((n, h, w, 3), dtype=torch.uint8)
+    # Allocate in shared memory so handing the bag to the main process is free.
+    if hasattr(torch, 'UntypedStorage'):
+        storage = torch.UntypedStorage._new_shared(numel)
+    else:
+        storage = torch.ByteStorage._new_shared(numel)
+    return torch.empty(0, dtype=torch.uint8).set_(storage).view(n, h, w, 3)
+
+
+class PinnedRing(object):
+    """Round-robin uint8 (n, h, w, 3) buffers grown to the largest bag seen.
+
+    A slot is written again `depth` bags later, so a bag (and its
+    non_blocking host-to-device copy) must be consumed by then.
+    """
+    def __init__(self, depth=4, pin=None):
+        self.depth = depth
+        self.pin = torch.cuda.is_available() if pin is None else pin
+        self.slots = [None] * depth
+        self.i = 0
+
+    def get(self, n, h, w):
+        slot = self.slots[self.i]
+        if slot is None or slot.shape[0] < n or slot.shape[1:] != (h, w, 3):
+            slot = torch.empty((n, h, w, 3), dtype=torch.uint8, pin_memory=self.pin)
+            self.slots[self.i] = slot
+        self.i = (self.i + 1) % self.depth
+        return slot[:n]
+
+
+def collate_tiles(imgs, inverse=None, ring=None):
+    # Decoded HWC pixels are copied once, straight into an NHWC buffer; the
+    # NCHW view returned has channels_last strides and the layout change to
+    # the model's memory format happens on the device.
+    arrs = [np.asarray(img, dtype=np.uint8) for img in imgs]
+    order = range(len(arrs)) if inverse is None else inverse
+    h, w = arrs[0].shape[:2]
+    out = ring.get(len(order), h, w) if ring is not None else empty_tiles(len(order), h, w)
+    dst = out.numpy()
+    for i, j in enumerate(order):
+        dst[i] = arrs[j]
+    return out.permute(0, 3, 1, 2)
+
+
+class DecodeCounter(object):
+    """Tiles requested vs distinct tiles decoded over the bags of an epoch."""
+    def __init__(self):
+        self.bags = 0
+        self.tiles = 0
+        self.unique = 0
+
+    def update(self, indices, bags=1):
+        self.bags += bags
+        self.tiles += len(indices)
+        self.unique += len(np.unique(indices))
+        return indices
+
+    def __str__(self):
+        saved = 1. - self.unique / self.tiles if self.tiles else 0.
+        return 'Bags: {} Tiles: {} Decoded: {} ({:.1%} saved)'.format(self.bags, self.tiles, self.unique, saved)
+
+
+class DistSlideSampler(DistributedSampler):
+    def __init__(self, dataset, padding, seed, shuffle=False, bags=1):
+        super(DistSlideSampler, self).__init__(dataset)
+        self.counter = DecodeCounter()
+        self.all_slide = dataset.slide
+        self.slide = dataset.slide
+        self.indices = dataset.indices
+        self.padding = padding
+        self.seed = stable_seed(seed)
+        self.bags = bags
+        
+    def __iter__(self):
+        # `bags` slides are packed into each batch.
+        self.counter = DecodeCounter()
+        plan = self.plan(self.epoch)
+        for i in range(0, len(plan), self.bags):
+            yield self.counter.update(plan[i:i+self.bags].reshape(-1), len(plan[i:i+self.bags]))
+        
+    def __len__(self):
+        return -(-(len(self.slide) // self.num_replicas) // self.bags)
+
+    def set_slides(self, ptids):
+        slide = self.all_slide.reshape(-1, 2)
+        self.slide = slide[np.isin(slide[:, 0], list(ptids))]
+
+    def plan(self, epoch):
+        # The epoch's bags for this rank as one (bags, padding*(extd+1)) array.
+        # The slide order depends only on (seed, epoch), so ranks stay
+        # disjoint; cluster draws also depend on the rank.
+        order = np.random.default_rng((self.seed, epoch)).permutation(len(self.slide) - len(self.slide)%self.num_replicas)
+        rng = np.random.default_rng((self.seed, epoch, self.rank))
+        return self.indices.sample(self.slide[order[self.rank::self.num_replicas]], self.padding, rng)
+
+
+class TestDistSlideSampler(DistributedSampler):
+    def __init__(self, dataset, limit=512, shuffle=False, balance=False, bags=1, chunk=None):
+        super(TestDistSlideSampler, self).__init__(dataset)
+        self.counter = DecodeCounter()
+        self.all_slide = dataset.slide
+        self.slide = dataset.slide
+        self.indices = dataset.indices
+        self.limit = limit
+        self.balance = balance
+        self.bags = bags
+        self.chunk = chunk
+        self.positions = self.shard()
+        
+    def __len__(self):
+        if self.chunk:
+            return sum(-(-len(self.indices[tuple(key)]) // self.chunk) for key in self.slide[self.shard()])
+        return -(-len(self.shard()) // self.bags)
+
+    def set_slides(self, ptids):
+        slide = self.all_slide.reshape(-1, 2)
+        self.slide = slide[np.isin(slide[:, 0], list(ptids))]
+    
+    def shard(self):
+        # Positions in self.slide evaluated by this rank. 'balance' assigns
+        # every slide once, spreading bag tiles evenly over the ranks;
+        # otherwise slides are strided and the first len % num_replicas dropped.
+        if not self.balance:
+            return np.arange(len(self.slide))[len(self.slide)%self.num_replicas:][self.rank::self.num_replicas]
+        limit = self.limit if not self.chunk else None
+        costs = [len(self.indices[tuple(key)][:limit]) * self.indices.width for key in self.slide]
+        return balance_shards(costs, self.num_replicas)[self.rank]
+    
+    def __iter__(self):
+        self.counter = DecodeCounter()
+        self.positions = self.shard()
+        slides = self.slide[self.positions]
+        if self.chunk:
+            # Every cluster of each slide, chunk clusters at a time.
+            for ptid, slide in slides:
+                indice = self.indices[(ptid, slide)]
+                for j in range(0, len(indice), self.chunk):
+                    yield self.counter.update(indice[j:j+self.chunk].flatten(), int(j == 0))
+            return
+        for i in range(0, len(slides), self.bags):
+            bags = [self.get_slide(ptid, slide) for ptid, slide in slides[i:i+self.bags]]
+            yield self.counter.update(np.concatenate(bags), len(bags))
+            
+    def get_slide(self, ptid, slide):
+        indice = self.indices[(ptid, slide)]
+        patch_num = len(indice)
+        if patch_num > self.limit:
+            indice = indice[random.Random(666).sample(range(patch_num), self.limit)]
+            return indice.flatten()
+        else:
+            return np.array(indice).flatten()
+
+
+def fast_collate(batch, ring=None):
+    inverse = getattr(batch, 'inverse', None)
+    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
+    tensor = collate_tiles([img[0] for img in batch], inverse, ring)
+    if inverse is not None:
+        targets = targets[torch.from_numpy(inverse)]
+    segments = getattr(batch, 'segments', None)
+    segments = torch.zeros(len(targets), dtype=torch.int64) if segments is None else torch.from_numpy(segments)
+    return tensor, targets, segments
+
+
+def unique_collate(batch, ring=None):
+    # Every distinct tile of the bag comes once, with its dataset index;
+    # targets and segments follow the sampled clusters, which inverse maps
+    # onto the tile rows.
+    if isinstance(batch, tuple):
+        return batch
+    inverse = getattr(batch, 'inverse', None)
+    inverse = torch.arange(len(batch)) if inverse is None else torch.from_numpy(inverse)
+    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)[inverse]
+    tensor = collate_tiles([img[0] for img in batch], None, ring)
+    segments = getattr(batch, 'segments', None)
+    segments = torch.zeros(len(targets), dtype=torch.int64) if segments is None else torch.from_numpy(segments)
+    indices = getattr(batch, 'indices', None)
+    indices = torch.zeros(len(batch), dtype=torch.int64) if indices is None else torch.from_numpy(indices)
+    return tensor, targets, segments, indices, inverse
+
+
+def default_device():
+    if torch.cuda.is_available():
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+class data_prefetcher(object):
+    """Moves bags to the device and normalizes them one bag ahead of compute.
+
+    On CUDA the copy and normalization run on a side stream. On CPU a
+    background thread fills a bounded queue, so decoding and conversion
+    overlap with the forward pass. transform, if given, runs on the device
+    input (e.g. augment.BagAugment). Only uint8 inputs are converted and
+    normalized. next() returns the loader's tuple, then Nones when exhausted
+    (width of them if the loader was empty). Use it as a context manager,
+    or call close(), so the fill thread and loader workers stop on any exit.
+    """
+    def __init__(self, loader, mean=TILE_MEAN, std=TILE_STD, memory_format=torch.contiguous_format, device=None, depth=2, transform=None, width=2):
+        self.loader = iter(loader)
+        self.transform = transform
+        self.device = torch.device(device) if device is not None else default_device()
+        self.memory_format = memory_format
+        self.mean = torch.tensor(mean, device=self.device).view(1, 3, 1, 1)
+        self.std = torch.tensor(std, device=self.device).view(1, 3, 1, 1)
+        self.width = width
+        self.done = False
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(self.device)
+            self.preload()
+        else:
+            self.queue = queue.Queue(maxsize=depth)
+            self.stop = threading.Event()
+            self.thread = threading.Thread(target=self.fill, daemon=True)
+            self.thread.start()
+
+    def prepare(self, batch):
+        input = batch[0].to(self.device, non_blocking=True)
+        if self.transform is not None:
+            input = self.transform(input)
+        if input.dtype == torch.uint8:
+            input = input.to(dtype=torch.float, memory_format=self.memory_format)
+            input.sub_(self.mean).div_(self.std)
+        rest = tuple(b.to(self.device, non_blocking=True) if torch.is_tensor(b) else b for b in batch[1:])
+        return (input,) + rest
+
+    def preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = self.prepare(batch)
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fill(self):
+        try:
+            for batch in self.loader:
+                if not self.put(self.prepare(batch)):
+                    return
+        except Exception as e:
+            self.put(e)
+            return
+        self.put(None)
+
+    def next(self):
+        if self.done:
+            return (None,) * self.width
+        if self.device.type == 'cuda':
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            batch = self.next_batch
+            if batch is not None:
+                for b in batch:
+                    if torch.is_tensor(b):
+                        b.record_stream(torch.cuda.current_stream(self.device))
+                self.preload()
+        else:
+            batch = self.queue.get()
+            if isinstance(batch, Exception):
+                self.done = True
+                raise batch
+        if batch is None:
+            self.done = True
+            return (None,) * self.width
+        self.width = len(batch)
+        return batch
+
+    def close(self):
+        # Stop the fill thread and drop the loader iterator so its workers
+        # shut down; safe to call more than once.
+        if self.loader is None:
+            return
+        if self.device.type == 'cuda':
+            self.next_batch = None
+        else:
+            self.stop.set()
+            if self.thread is not threading.current_thread():
+                self.thread.join()
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+        self.loader = None
+        self.done = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, 'loader', None) is not None:
+            self.close()
@@ -0,0 +1,235 @@
+from __future__ import print_function
+import numpy as np
+import hashlib
+import os
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset, DataLoader, BatchSampler, SequentialSampler
+from mil_ops import segment_ids
+from bag_loader import data_prefetcher, TILE_MEAN, TILE_STD
+from tile_io import transform_key, create_once
+
+
+class EmbeddingBags(Dataset):
+    """Bags of cached backbone embeddings, indexed like the tile dataset.
+
+    __getitems__ returns the (tiles, L) float embeddings of a sampler batch
+    with its per-tile targets and segment ids, the same tuple fast_collate
+    builds from pixels, so the samplers and loops are shared.
+    """
+    def __init__(self, embeddings, dataset):
+        self.embeddings = embeddings
+        self.label = dataset.label
+        self.slide = dataset.slide
+        self.indices = dataset.indices
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        return embedding_batch(self.embeddings[indices], self.label, indices)
+
+
+def embedding_batch(H, label, indices):
+    # Embeddings of a sampler batch with its per-tile targets and segment ids.
+    slides = np.searchsorted(label.offsets, indices, side='right') - 1
+    return (torch.from_numpy(np.asarray(H, dtype=np.float32)),
+            torch.from_numpy(np.asarray(label.labels[slides], dtype=np.int64)),
+            torch.from_numpy(segment_ids(label.offsets, indices)))
+
+
+def embedding_collate(batch):
+    return batch
+
+
+def weights_key(module):
+    h = hashlib.md5()
+    for name, value in sorted(module.state_dict().items()):
+        h.update(name.encode('utf-8'))
+        h.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+class EmbeddingStore(object):
+    """Backbone embeddings of evaluation tiles, kept across runs.
+
+    Slide i is a float16 (tiles, width) memmap in dataset tile order with a
+    mask of filled rows, named after the slide's tile names, under a
+    directory keyed by the backbone weights, the transform, data root,
+    magnification, normalization and (unless fp32) the inference precision.
+    A checkpoint, preprocessing or precision change therefore starts a new
+    set, and a re-tiled slide gets new arrays. Slides are evicted least
+    recently used first once the whole store exceeds max_bytes. use()
+    switches to another dataset with the same transform.
+    """
+    def __init__(self, root, backbone, dataset, data_root, Mag, mean=TILE_MEAN, std=TILE_STD, width=512, max_bytes=None, precision='fp32'):
+        spec = '|'.join([weights_key(backbone), transform_key(dataset.data_transforms, data_root, Mag), repr(tuple(mean)), repr(tuple(std))])
+        if precision != 'fp32':
+            spec += '|' + precision
+        self.root = root
+        self.dir = os.path.join(root, hashlib.md5(spec.encode('utf-8')).hexdigest()[:16])
+        self.width = width
+        self.max_bytes = max_bytes
+        self.size = None
+        self.use(dataset)
+
+    def use(self, dataset):
+        self.slides = [tuple(key) for key in dataset.slide]
+        self.offsets = dataset.label.offsets
+        self.names = dataset.patch.names
+        self.prefixes = {}
+        self.arrays = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = {}
+        return state
+
+    def prefix(self, i):
+        if i not in self.prefixes:
+            ptid, slide = self.slides[i]
+            ids = np.ascontiguousarray(self.names[self.offsets[i]:self.offsets[i+1]])
+            key = hashlib.md5(ids.dtype.str.encode('utf-8') + ids.tobytes()).hexdigest()[:16]
+            self.prefixes[i] = os.path.join(self.dir, ptid, slide, key)
+        return self.prefixes[i]
+
+    def slide(self, i, create=False):
+        if i in self.arrays:
+            return self.arrays[i]
+        prefix = self.prefix(i)
+        created = False
+        if not os.path.exists(prefix + '.mask.npy'):
+            if not create:
+                return None
+            # Built aside and linked in; the mask goes last, and readers
+            # treat a slide without it as absent. Arrays another rank or
+            # worker created, and may be filling, are never replaced.
+            n = int(self.offsets[i+1] - self.offsets[i])
+            os.makedirs(os.path.dirname(prefix), exist_ok=True)
+            tmp = f'{prefix}.{os.getpid()}.tmp'
+            np.lib.format.open_memmap(tmp + '.npy', mode='w+', dtype=np.float16, shape=(n, self.width)).flush()
+            create_once(tmp + '.npy', prefix + '.npy')
+            np.save(tmp + '.mask.npy', np.zeros(n, dtype=np.bool_))
+            create_once(tmp + '.mask.npy', prefix + '.mask.npy')
+            created = True
+        try:
+            arrays = np.load(prefix + '.npy', mmap_mode='r+'), np.load(prefix + '.mask.npy', mmap_mode='r+')
+        except (OSError, ValueError, EOFError):
+            # Evicted by another process meanwhile.
+            return None
+        os.utime(prefix + '.npy')
+        self.arrays[i] = arrays
+        if created:
+            self.evict(sum(os.path.getsize(prefix + ext) for ext in ('.npy', '.mask.npy')))
+        return arrays
+
+    def lookup(self, indices):
+        # (len(indices), width) float32 embeddings and the mask of rows found.
+        indices = np.asarray(indices)
+        H = np.zeros((len(indices), self.width), dtype=np.float32)
+        hit = np.zeros(len(indices), dtype=bool)
+        slides = np.searchsorted(self.offsets, indices, side='right') - 1
+        for i in np.unique(slides):
+            arrays = self.slide(int(i))
+            if arrays is None:
+                continue
+            sel = np.flatnonzero(slides == i)
+            rows = indices[sel] - self.offsets[i]
+            found = np.asarray(arrays[1][rows])
+            H[sel[found]] = arrays[0][rows[found]]
+            hit[sel] = found
+        return H, hit
+
+    def put(self, indices, H):
+        indices = np.asarray(indices)
+        slides = np.searchsorted(self.offsets, indices, side='right') - 1
+        for i in np.unique(slides):
+            arrays = self.slide(int(i), create=True)
+            if arrays is None:
+                continue
+            emb, mask = arrays
+            sel = slides == i
+            rows = indices[sel] - self.offsets[i]
+            emb[rows] = H[sel]
+            mask[rows] = True
+
+    def embed(self, backbone, x, indices):
+        # backbone(x), running it only on the tiles not stored yet.
+        indices = np.asarray(indices.cpu() if torch.is_tensor(indices) else indices)
+        H, hit = self.lookup(indices)
+        H = torch.from_numpy(H).to(x.device)
+        if not hit.all():
+            miss = np.flatnonzero(~hit)
+            # Rounded to the stored float16, so a slide scores the same
+            # whether its embeddings were cached or not.
+            out = backbone(x[torch.from_numpy(miss).to(x.device)]).half()
+            H[torch.from_numpy(miss).to(x.device)] = out.float()
+            self.put(indices[miss], out.cpu().numpy())
+        return H
+
+    def evict(self, added=0):
+        # The store is walked once for its size, which then grows by the
+        # slides this process adds; it is walked again (also counting other
+        # ranks' slides) only once that total exceeds max_bytes.
+        if not self.max_bytes:
+            return
+        if self.size is not None:
+            self.size += added
+            if self.size <= self.max_bytes:
+                return
+        entries = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.mask.npy'):
+                    prefix = os.path.join(dirpath, name[:-len('.mask.npy')])
+                    paths = [prefix + ext for ext in ('.npy', '.mask.npy')]
+                    try:
+                        entries.append((os.stat(paths[0]).st_mtime, sum(os.path.getsize(p) for p in paths), prefix, paths))
+                    except OSError:
+                        continue
+        total = sum(e[1] for e in entries)
+        open_prefixes = set(self.prefix(i) for i in self.arrays)
+        for _, size, prefix, paths in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if prefix in open_prefixes:
+                continue
+            for p in paths[::-1]:
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
+        self.size = total
+
+
+def extract_embeddings(backbone, dataset, path, width, collate_fn, batch_size=256, workers=0, mean=None, device=None):
+    # One pass of backbone over every tile of dataset (whose transform must
+    # be deterministic) into a float16 (tiles, width) .npy at path. Ranks take
+    # interleaved batches; a finished file is reused as is.
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    world_size = dist.get_world_size() if distributed else 1
+    done = path + '.done'
+    if not os.path.exists(done):
+        if rank == 0:
+            np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=(len(dataset), width)).flush()
+        if distributed:
+            dist.barrier()
+        out = np.load(path, mmap_mode='r+')
+        batches = list(BatchSampler(SequentialSampler(range(len(dataset))), batch_size, drop_last=False))[rank::world_size]
+        loader = DataLoader(dataset, batch_sampler=batches, num_workers=workers, collate_fn=collate_fn)
+        backbone.eval()
+        with data_prefetcher(loader, device=device, **({} if mean is None else dict(mean=mean))) as prefetcher, torch.no_grad():
+            for batch in batches:
+                out[batch[0]:batch[-1]+1] = backbone(prefetcher.next()[0]).float().cpu().numpy()
+        out.flush()
+        del out
+        if distributed:
+            dist.barrier()
+        if rank == 0:
+            open(done, 'w').close()
+    if distributed:
+        dist.barrier()
+    return np.load(path, mmap_mode='r')
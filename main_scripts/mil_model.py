@@ -0,0 +1,260 @@
+from __future__ import print_function
+import numpy as np
+import collections
+import contextlib
+import torch
+import torch.nn as nn
+import torchvision
+from mil_ops import segment_softmax, segment_sum, attention_pool, backbone_stages, checkpoint_stages
+
+
+Backbone = collections.namedtuple('Backbone', ['build', 'head', 'width', 'pretrained'])
+
+# name -> how to build the feature extractor: build(pretrained) returns the
+# torchvision net, whose `head` attribute is replaced by a Linear from
+# `width` features to L. `pretrained` is whether it starts from ImageNet
+# weights. Unknown names fall back to inceptionv3.
+BACKBONES = {}
+
+
+def register_backbone(name, build, head, width, pretrained=False):
+    BACKBONES[name] = Backbone(build, head, width, pretrained)
+
+
+register_backbone('alexnet', lambda pretrained: torchvision.models.alexnet(pretrained=pretrained), 'classifier', 9216)
+register_backbone('vgg11', lambda pretrained: torchvision.models.vgg11(pretrained=pretrained), 'classifier', 25088)
+register_backbone('resnet50', lambda pretrained: torchvision.models.resnet50(pretrained=pretrained), 'fc', 2048, pretrained=True)
+register_backbone('densenet121', lambda pretrained: torchvision.models.densenet121(pretrained=pretrained), 'classifier', 1024)
+register_backbone('squeezenet1_0', lambda pretrained: torchvision.models.squeezenet1_0(pretrained=pretrained), 'classifier', 512)
+register_backbone('inceptionv3', lambda pretrained: torchvision.models.inception_v3(pretrained=pretrained, aux_logits=False), 'fc', 2048, pretrained=True)
+
+
+def backbone_spec(name):
+    return BACKBONES.get(name, BACKBONES['inceptionv3'])
+
+
+def build_backbone(name, L=512, pretrain=True):
+    spec = backbone_spec(name)
+    net = spec.build(pretrain and spec.pretrained)
+    fc = nn.Linear(spec.width, L)
+    nn.init.xavier_normal_(fc.weight)
+    if isinstance(net, torchvision.models.SqueezeNet):
+        # SqueezeNet's classifier gets the feature map, not a pooled vector.
+        fc = nn.Sequential(nn.AdaptiveAvgPool2d(1), nn.Flatten(), fc)
+    setattr(net, spec.head, fc)
+    return net
+
+
+def lazy_init(lazy):
+    # Modules built inside get meta parameters: no memory and no random
+    # init, which dominates construction time. The caller materializes them
+    # with to_empty() and fills them from a checkpoint.
+    if lazy and hasattr(torch.device, '__enter__'):
+        return torch.device('meta')
+    return contextlib.nullcontext()
+
+
+# Evaluation precisions: the backbone and cluster encoder run under
+# autocast to the dtype, Attention_Gated keeps the slide head in fp32.
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16}
+
+
+def inference_precision(precision, device):
+    dtype = PRECISIONS[precision]
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=dtype)
+
+
+def full_precision(device):
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device.type, enabled=False)
+    return contextlib.nullcontext()
+
+
+_profiles = {}
+
+
+def profile_backbone(name, size=224):
+    # (FLOPs, parameters) of a backbone with its L-wide head for one
+    # size x size tile, counted by thop on a separate uninitialized copy,
+    # once per process.
+    key = (name if name in BACKBONES else 'inceptionv3', size)
+    if key not in _profiles:
+        from thop import profile
+        with lazy_init(True):
+            net = build_backbone(name, pretrain=False)
+        net = net.to_empty(device='cpu').eval()
+        with torch.no_grad():
+            _profiles[key] = profile(net, inputs=(torch.zeros(1, 3, size, size), ))
+    return _profiles[key]
+
+
+class Attention_Gated(nn.Module):
+    """Gated-attention MIL over clusters of a tile and its extd neighbours.
+
+    The backbone comes from BACKBONES. lazy builds the parameters
+    uninitialized, for models that load a checkpoint right after; profile
+    prints the backbone FLOPs and parameter count (needs thop).
+    """
+    def __init__(self, model='inceptionv3', pretrain=True, extd=7, checkpoint_segments=0, checkpoint_encoder=False, lazy=False, profile=False):
+        super(Attention_Gated, self).__init__()
+        self.extd = extd
+        self.checkpoint_segments = checkpoint_segments
+        self.checkpoint_encoder = checkpoint_encoder
+        self.L = 512
+        self.D = 128
+        self.K = 1
+
+        if profile:
+            flops, params = profile_backbone(model)
+            print('FLOPS:', flops)
+            print('PARAMS:', params)
+
+        meta = lazy_init(lazy)
+        with meta:
+            self.feature_extractor = build_backbone(model, self.L, pretrain and not lazy)
+
+            self.encoder = nn.TransformerEncoder(
+                nn.TransformerEncoderLayer(d_model=self.L,
+                                           nhead=8,
+                                           activation='gelu'),
+                num_layers=2,
+                norm=nn.LayerNorm(normalized_shape=self.L, eps=1e-6)
+            )
+
+            self.inner_attention = nn.Linear(self.L, self.K)
+            nn.init.xavier_normal_(self.inner_attention.weight)
+
+            self.attention = nn.Linear(self.L, self.K)
+            nn.init.xavier_normal_(self.attention.weight)
+
+            self.classifier = nn.Sequential(
+                nn.Linear(self.L*self.K, 1),
+                nn.Sigmoid()
+            )
+            nn.init.xavier_normal_(self.classifier[0].weight)
+        if isinstance(meta, torch.device):
+            self.to_empty(device='cpu')
+
+    def features(self, x):
+        # feature_extractor(x). When training with checkpoint_segments, only
+        # the activations at the segment boundaries are kept for backward and
+        # the rest are recomputed, trading compute for larger bags.
+        if not (self.checkpoint_segments and self.training and torch.is_grad_enabled()):
+            return self.feature_extractor(x)
+        stages, head = backbone_stages(self.feature_extractor)
+        return head(checkpoint_stages(stages, x, self.checkpoint_segments))
+
+    def encode(self, H):
+        if not (self.checkpoint_encoder and self.training and torch.is_grad_enabled()):
+            return self.encoder(H)
+        stages = list(self.encoder.layers) + ([self.encoder.norm] if self.encoder.norm is not None else [])
+        return checkpoint_stages(stages, H, len(stages))
+
+    def clusters(self, x, inverse=None):
+        # (clusters, L) features of the clusters in x, before slide attention.
+        # x is either tiles or their cached (tiles, L) feature_extractor
+        # embeddings. With inverse, x holds each distinct tile once and
+        # H[inverse] lays the embeddings out as the sampled clusters, so
+        # shared tiles pass the backbone once.
+        x = x.squeeze(0)
+        H = self.features(x) if x.dim() == 4 else x
+        if inverse is not None:
+            H = H[inverse]
+        H = H.view((-1, self.extd+1, self.L))
+        H = self.encode(H.transpose(0,1))
+        H = H.transpose(0,1)
+
+        return attention_pool(H, self.inner_attention(H))
+
+    def forward(self, x, segments=None, inverse=None):
+        # segments: bag number of every tile when several slides are packed
+        # into one batch; Y_prob has one row per bag.
+        H = self.clusters(x, inverse)
+
+        if segments is None:
+            segments = torch.zeros(len(H), dtype=torch.int64, device=H.device)
+        else:
+            segments = segments[::self.extd+1]
+        bags = int(segments[-1]) + 1
+        # The slide attention and classifier stay in fp32 under autocast:
+        # they are cheap, and Y_prob near 0 or 1 does not survive bfloat16.
+        with full_precision(H.device):
+            H = H.float()
+            A = segment_softmax(self.attention(H).squeeze(1), segments, bags)
+
+            M = segment_sum(A.unsqueeze(1) * H, segments, bags)
+            Y_prob = self.classifier(M)
+
+        return Y_prob
+
+
+def reduce_tensor(tensor: torch.Tensor) -> torch.Tensor:
+    rt = tensor.clone()
+    torch.distributed.all_reduce(rt, op=torch.distributed.ReduceOp.SUM)
+    return rt
+
+
+def gather_tensor(tensor: torch.Tensor):
+    rt = tensor.clone()
+    var_list = [torch.zeros_like(rt) for _ in range(torch.distributed.get_world_size())]
+    torch.distributed.all_gather(var_list, rt, async_op=False)
+    return [v for i in var_list for v in i.view(-1).tolist()]
+
+
+def gather_ordered(positions, *columns):
+    # Every rank's (position, column...) rows, sorted back into slide order.
+    # Ranks may hold different numbers of rows.
+    device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else torch.device('cpu')
+    rows = torch.tensor(np.column_stack([positions] + list(columns)), dtype=torch.float64, device=device).reshape(-1, 1+len(columns))
+    world_size = torch.distributed.get_world_size()
+    sizes = [torch.zeros(1, dtype=torch.int64, device=device) for _ in range(world_size)]
+    torch.distributed.all_gather(sizes, torch.tensor([len(rows)], device=device))
+    padded = torch.zeros(max(int(n) for n in sizes), rows.shape[1], dtype=rows.dtype, device=device)
+    padded[:len(rows)] = rows
+    parts = [torch.zeros_like(padded) for _ in range(world_size)]
+    torch.distributed.all_gather(parts, padded)
+    rows = torch.cat([part[:int(n)] for part, n in zip(parts, sizes)]).cpu().numpy()
+    rows = rows[np.argsort(rows[:, 0], kind='stable')]
+    return [rows[:, 0].astype(np.int64)] + [rows[:, i].tolist() for i in range(1, rows.shape[1])]
+
+
+def get_cm(AllLabels, AllValues):
+    from sklearn.metrics import roc_curve, auc, confusion_matrix
+    fpr, tpr, threshold = roc_curve(AllLabels, AllValues, pos_label=1)
+    Auc = auc(fpr, tpr)
+    m = t = 0
+
+    for i in range(len(threshold)):
+        if tpr[i] - fpr[i] > m :
+            m = abs(-fpr[i]+tpr[i])
+            t = threshold[i]
+    AllPred = [int(i>=t) for i in AllValues]
+    Acc = sum([AllLabels[i] == AllPred[i] for i in range(len(AllPred))]) / len(AllPred)
+
+    Pos_num = sum(AllLabels)
+    Neg_num = len(AllLabels) - Pos_num
+    cm = confusion_matrix(AllLabels, AllPred)
+    print("[AUC/{:.4f}] [Threshold/{:.4f}] [Acc/{:.4f}]".format(Auc, t,  Acc))
+    print("{:.2f}% {:.2f}%".format(cm[0][0]/ Neg_num * 100, cm[0][1]/Neg_num * 100))
+    print("{:.2f}% {:.2f}%".format(cm[1][0]/ Pos_num * 100, cm[1][1]/Pos_num * 100))
+    
+    return Auc, Acc
+
+
+def get_auc(ture, pred):
+    from sklearn import metrics
+    fpr, tpr, thresholds = metrics.roc_curve(ture, pred, pos_label=1)
+    return metrics.auc(fpr, tpr)
+
+
+def save_roc(ture, pred, imgn):
+    from sklearn import metrics
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    fpr, tpr, thresholds = metrics.roc_curve(ture, pred, pos_label=1)
+    plt.cla()
+    plt.plot(fpr,tpr)
+    plt.savefig(f'{imgn}.jpg')
+    return
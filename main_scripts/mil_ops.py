@@ -0,0 +1,150 @@
+from __future__ import print_function
+import numpy as np
+import contextlib
+import inspect
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision
+from torch.utils.checkpoint import checkpoint
+
+
+def segment_ids(offsets, indices):
+    # Bag number of every tile of a packed batch. Tiles are grouped by the
+    # slide (offsets from SlideLabels) they belong to, numbered in order of
+    # appearance; the samplers never put a slide twice in one batch.
+    slides = np.searchsorted(offsets, np.asarray(indices), side='right') - 1
+    starts = np.ones(len(slides), dtype=bool)
+    starts[1:] = slides[1:] != slides[:-1]
+    return np.cumsum(starts) - 1
+
+
+def segment_starts(segments):
+    starts = torch.ones_like(segments, dtype=torch.bool)
+    starts[1:] = segments[1:] != segments[:-1]
+    return starts
+
+
+def segment_max(x, segments, num_segments):
+    out = x.new_full((num_segments,), float('-inf'))
+    if hasattr(out, 'scatter_reduce_'):
+        return out.scatter_reduce_(0, segments, x, reduce='amax')
+    return torch.stack([x[segments == s].max() for s in range(num_segments)])
+
+
+def segment_sum(x, segments, num_segments):
+    return x.new_zeros((num_segments,) + x.shape[1:]).index_add_(0, segments, x)
+
+
+def segment_softmax(x, segments, num_segments):
+    # Softmax over the entries of x sharing a segment id. The shift does not
+    # change the result or its gradient, so it is taken out of the graph.
+    e = (x - segment_max(x.detach(), segments, num_segments)[segments]).exp()
+    return e / segment_sum(e, segments, num_segments)[segments]
+
+
+def attention_pool(H, scores):
+    # Attention-weighted sum over the tiles of every cluster in one batched
+    # matmul: H is (clusters, tiles, L), scores the (clusters, tiles, 1) logits.
+    return torch.bmm(F.softmax(scores, dim=1).transpose(1, 2), H).squeeze(1)
+
+
+class OnlineAttention(object):
+    """Attention pooling over a bag that arrives in chunks.
+
+    add() takes the (n, L) features and (n,) attention logits of a chunk and
+    keeps only the running max, the sum of exp(logit - max) and the matching
+    weighted sum of features, rescaled whenever the max grows. pool() then
+    equals softmax(all logits) @ all features in O(L) memory.
+    """
+    def __init__(self):
+        self.max = None
+        self.sum = None
+        self.acc = None
+
+    def add(self, H, scores):
+        m = scores.max()
+        if self.max is not None:
+            m = torch.maximum(m, self.max)
+        e = (scores - m).exp()
+        if self.max is None:
+            self.sum, self.acc = e.sum(), e @ H
+        else:
+            scale = (self.max - m).exp()
+            self.sum = self.sum * scale + e.sum()
+            self.acc = self.acc * scale + e @ H
+        self.max = m
+
+    def pool(self):
+        return (self.acc / self.sum).unsqueeze(0)
+
+    def logsumexp(self):
+        return self.max + self.sum.log()
+
+
+def backbone_stages(net):
+    # A torchvision feature extractor as (stages, head): the stages run in
+    # order and then head reproduce net(x). The stages are the blocks worth
+    # checkpointing; head is the cheap pooling + replaced final Linear.
+    models = torchvision.models
+    if isinstance(net, models.Inception3):
+        names = [n for n, m in net.named_children() if m is not None and n != 'AuxLogits']
+        stages = [net._transform_input] + [getattr(net, n) for n in names[:names.index('avgpool')]]
+        return stages, lambda x: net.fc(torch.flatten(net.dropout(net.avgpool(x)), 1))
+    if isinstance(net, models.ResNet):
+        stages = [net.conv1, net.bn1, net.relu, net.maxpool, net.layer1, net.layer2, net.layer3, net.layer4]
+        return stages, lambda x: net.fc(torch.flatten(net.avgpool(x), 1))
+    if isinstance(net, models.DenseNet):
+        stages = list(net.features.children()) + [F.relu]
+        return stages, lambda x: net.classifier(torch.flatten(F.adaptive_avg_pool2d(x, (1, 1)), 1))
+    if isinstance(net, (models.AlexNet, models.VGG)):
+        return list(net.features.children()), lambda x: net.classifier(torch.flatten(net.avgpool(x), 1))
+    if isinstance(net, models.SqueezeNet):
+        return list(net.features.children()), lambda x: torch.flatten(net.classifier(x), 1)
+    raise ValueError('no checkpoint stages for {}'.format(type(net).__name__))
+
+
+@contextlib.contextmanager
+def frozen_batchnorm_stats(stages):
+    # Recomputing a checkpointed segment must not move the batch-norm
+    # running statistics a second time.
+    bns = [m for stage in stages if isinstance(stage, nn.Module) for m in stage.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momenta = [bn.momentum for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.
+    try:
+        yield
+    finally:
+        for bn, momentum in zip(bns, momenta):
+            bn.momentum = momentum
+
+
+def checkpoint_stages(stages, x, segments):
+    # Runs stages in order, keeping activations only at the boundaries of
+    # `segments` contiguous groups; the inside of each group is recomputed
+    # during backward.
+    bounds = np.linspace(0, len(stages), min(segments, len(stages)) + 1).round().astype(int)
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        group = stages[a:b]
+        def run(x, group=group):
+            if getattr(group[0], 'inplace', False):
+                # e.g. a ReLU(inplace=True) opening the segment would
+                # overwrite the boundary activation kept for recomputation.
+                x = x.clone()
+            for stage in group:
+                x = stage(x)
+            return x
+        if 'context_fn' in inspect.signature(checkpoint).parameters:
+            x = checkpoint(run, x, use_reentrant=False,
+                           context_fn=lambda group=group: (contextlib.nullcontext(), frozen_batchnorm_stats(group)))
+        else:
+            # The reentrant form runs the segment under no_grad and recomputes
+            # it with grad enabled in backward, so only that second pass
+            # freezes the statistics. It only backpropagates into parameters
+            # when its input requires grad.
+            def rerun(x, run=run, group=group):
+                with frozen_batchnorm_stats(group) if torch.is_grad_enabled() else contextlib.nullcontext():
+                    return run(x)
+            x = checkpoint(rerun, x if x.requires_grad else x.detach().requires_grad_())
+    return x
@@ -0,0 +1,48 @@
+from __future__ import print_function
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from tile_io import pack_dir, shard_is_current
+
+
+def list_tile_dirs(data_path, mags):
+    for ptid in sorted(os.listdir(data_path)):
+        if not os.path.isdir(os.path.join(data_path, ptid)):
+            continue
+        for slide in sorted(os.listdir(os.path.join(data_path, ptid))):
+            for mag in mags:
+                src = os.path.join(data_path, ptid, slide, mag)
+                if os.path.isdir(src):
+                    yield src, os.path.join(ptid, slide, mag)
+
+
+def pack_job(job):
+    src, dst, force = job
+    if not force and shard_is_current(src, dst):
+        return 0
+    return pack_dir(src, dst)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Pack each <ptid>/<slide>/<mag>/ tile directory into one shard file')
+    parser.add_argument('--path', default='/data_path/', type=str, help='path of patches')
+    parser.add_argument('--out', default='/shard_path/', type=str, help='output root of the shards')
+    parser.add_argument('--mag', default='10', type=str, help='comma separated magnifications, e.g. 10,20')
+    parser.add_argument('--workers', default=8, type=int)
+    parser.add_argument('--force', action='store_true', help='repack shards that are already up to date')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    mags = sorted(set(m for mag in args.mag.split(',') for m in (mag, mag.split('_')[0])))
+    jobs = [(src, os.path.join(args.out, rel), args.force) for src, rel in list_tile_dirs(args.path, mags)]
+    print('Tile directories:', len(jobs))
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        packed = list(executor.map(pack_job, jobs, chunksize=max(1, len(jobs)//(4*args.workers))))
+    print('Packed directories:', sum(n > 0 for n in packed))
+    print('Packed tiles:', sum(packed))
+    print('Time: {:.1f}s'.format(time.time()-start))
@@ -0,0 +1,461 @@
+from __future__ import print_function
+import numpy as np
+import os
+import sys
+import glob
+import copy
+import random
+import pickle
+import hashlib
+import heapq
+import time
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+
+
+MANIFEST_VERSION = 2
+# Seconds between manifest writes while slides are indexed one at a time.
+SAVE_INTERVAL = 60
+_MANIFESTS = {}
+
+
+def get_loc(img_name):
+    return np.array(list(map(int,img_name.split('/')[-1].split('.')[0].split('_'))))
+
+
+def resampling(list_0, num):
+    list_1 = copy.deepcopy(list_0)
+    list_2 = copy.deepcopy(list_0)
+    times = num // len(list_2)
+    if times > 1:
+        list_2.extend((times-1)*list_1)
+    random.seed(36)
+    list_2.extend(random.sample(list_2,num-len(list_2)))
+    return list_2
+
+
+def dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def trim_neighbours(nb, extd, seed=666):
+    # Drop surplus neighbours at random (one seeded draw for the whole
+    # table), keeping the survivors of each row in distance order.
+    if nb.shape[1] <= extd:
+        return nb
+    if extd == 0:
+        return nb[:, :0]
+    keys = np.random.default_rng(seed).random(nb.shape)
+    keep = np.sort(np.argpartition(keys, extd-1, axis=1)[:, :extd], axis=1)
+    return np.take_along_axis(nb, keep, axis=1)
+
+
+def _grid_offsets(R):
+    d = np.arange(-R, R+1)
+    dx, dy = np.meshgrid(d, d, indexing='ij')
+    dx, dy = dx.ravel(), dy.ravel()
+    d2 = dx*dx + dy*dy
+    order = np.argsort(d2, kind='stable')
+    return dx[order], dy[order], d2[order]
+
+
+class GridIndex(object):
+    """Occupancy index over integer tile coordinates.
+
+    Coordinates are reduced by their per-axis gcd so pixel-offset names
+    (0_512, 512_1024, ...) land on a unit grid. A dense cell array padded
+    by `pad` empty cells is used when the bounding box is small enough,
+    otherwise a sorted-key hash.
+    """
+    def __init__(self, loc, max_cells=1 << 26, pad=8):
+        loc = np.asarray(loc, dtype=np.int64)
+        self.origin = loc.min(0)
+        self.step = np.gcd.reduce(loc - self.origin, axis=0)
+        self.step[self.step == 0] = 1
+        cell = (loc - self.origin) // self.step
+        self.shape = cell.max(0) + 1
+        keys = cell[:, 0]*self.shape[1] + cell[:, 1]
+        self.pad = pad
+        self.dense = int(self.shape[0]+2*pad)*int(self.shape[1]+2*pad) <= max_cells
+        if self.dense:
+            self.grid = np.full(tuple(self.shape+2*pad), -1, dtype=np.int32)
+            self.grid[cell[:, 0]+pad, cell[:, 1]+pad] = np.arange(len(loc))
+            self.unique = np.count_nonzero(self.grid >= 0) == len(loc)
+        else:
+            self.order = np.argsort(keys, kind='stable')
+            self.keys = keys[self.order]
+            self.unique = not (self.keys[1:] == self.keys[:-1]).any()
+
+    def cells(self, loc):
+        rel = np.asarray(loc, dtype=np.int64) - self.origin
+        if (rel % self.step).any():
+            return None
+        return rel // self.step
+
+    def lookup(self, cx, cy):
+        if self.dense and cx.min() >= -self.pad and cy.min() >= -self.pad \
+                and cx.max() < self.shape[0]+self.pad and cy.max() < self.shape[1]+self.pad:
+            return self.grid[cx+self.pad, cy+self.pad]
+        out = np.full(cx.shape, -1, dtype=np.int64)
+        inside = (cx >= 0) & (cy >= 0) & (cx < self.shape[0]) & (cy < self.shape[1])
+        if self.dense:
+            out[inside] = self.grid[cx[inside]+self.pad, cy[inside]+self.pad]
+        else:
+            key = cx[inside]*self.shape[1] + cy[inside]
+            pos = np.clip(np.searchsorted(self.keys, key), 0, len(self.keys)-1)
+            out[inside] = np.where(self.keys[pos] == key, self.order[pos], -1)
+        return out
+
+
+def grid_kneighbors(loc_t, loc_a, k, max_radius=32, chunk=1 << 22):
+    # k nearest occupied cells of each query by Chebyshev ring expansion.
+    # Returns None when the tiles are not on a shared duplicate-free 2-D
+    # grid; rows still unresolved at max_radius fall back to sklearn.
+    loc_t, loc_a = np.asarray(loc_t), np.asarray(loc_a)
+    if loc_a.ndim != 2 or loc_a.shape[1] != 2 or len(loc_a) < k:
+        return None
+    index = GridIndex(loc_a)
+    cell_t = index.cells(loc_t) if index.unique else None
+    if cell_t is None:
+        return None
+
+    result = np.empty((len(loc_t), k), dtype=np.int64)
+    todo = np.arange(len(loc_t))
+    R = int(np.ceil((np.sqrt(k) - 1) / 2))
+    while len(todo) and R <= max_radius:
+        dx, dy, d2 = _grid_offsets(R)
+        rows = max(1, chunk // len(dx))
+        left = []
+        for s in range(0, len(todo), rows):
+            q = todo[s:s+rows]
+            cand = index.lookup(cell_t[q, 0, None] + dx, cell_t[q, 1, None] + dy)
+            valid = cand >= 0
+            cs = np.cumsum(valid, axis=1, dtype=np.int32)
+            # Anything outside the scanned square is at least R+1 away.
+            ok = (cs[:, -1] >= k) & (d2[np.argmax(cs >= k, axis=1)] <= (R+1)**2)
+            sel = valid[ok] & (cs[ok] <= k)
+            result[q[ok]] = cand[ok][sel].reshape(-1, k)
+            left.append(q[~ok])
+        todo = np.concatenate(left)
+        R += 1
+    if len(todo):
+        from sklearn.neighbors import NearestNeighbors
+        nbs = NearestNeighbors(n_neighbors=k).fit(loc_a)
+        result[todo] = nbs.kneighbors(loc_t[todo], return_distance=False)
+    return result
+
+
+def build_clusters(loc_t, loc_a, extd, engine='sklearn'):
+    # Cluster table of one slide in slide-local indices: column 0 is the
+    # centre tile (0..n_t-1), the rest are neighbours offset by n_t.
+    n_t = len(loc_t)
+    if n_t == 0:
+        return np.zeros((0, extd+1), dtype=np.int64)
+    nb = None
+    if engine == 'grid':
+        nb = grid_kneighbors(loc_t, loc_a, extd+1)
+    if nb is None:
+        # sklearn is only needed when a slide is (re)indexed.
+        from sklearn.neighbors import NearestNeighbors
+        nbs = NearestNeighbors(n_neighbors=extd+1).fit(loc_a)
+        nb = nbs.kneighbors(loc_t, return_distance=False)
+    nb = trim_neighbours(nb[:, 1:], extd)
+    return np.hstack([np.arange(n_t)[:, None], n_t + nb]).astype(np.int64)
+
+
+def pack_names(paths):
+    return np.array([os.path.basename(p).encode('utf-8') for p in paths], dtype='S')
+
+
+def index_slide(Data_path, ptid, slide, Mag, extd, engine='sklearn'):
+    # Slides of any size are indexed, so small ones are cached too; callers
+    # apply their tile limit to the entry.
+    dir_t = os.path.join(Data_path, ptid, slide, Mag)
+    dir_a = os.path.join(Data_path, ptid, slide, Mag.split('_')[0])
+    mtime = (dir_mtime(dir_t), dir_mtime(dir_a))
+    patches_t = glob.glob(os.path.join(dir_t, '*'))
+    patches_a = glob.glob(os.path.join(dir_a, '*'))
+
+    if patches_a and len(patches_a) < extd+1:
+        patches_a = resampling(patches_a, extd+1)
+
+    loc_t = np.array(list(map(get_loc, patches_t)))
+    loc_a = np.array(list(map(get_loc, patches_a)))
+    return {
+        'mtime': mtime,
+        'dir_t': dir_t,
+        'names_t': pack_names(patches_t),
+        'dir_a': dir_a,
+        'names_a': pack_names(patches_a),
+        'loc_a': loc_a.astype(np.int32),
+        'cluster': build_clusters(loc_t, loc_a, extd, engine).astype(np.int32),
+        'label': None,
+    }
+
+
+class SlideManifest(object):
+    """On-disk cache of per-slide tile lists, coordinates and cluster tables.
+
+    Entries are keyed by (ptid, slide) and revalidated against the mtimes of
+    the patient and magnification directories, so only slides whose tiles
+    changed since the last run are re-listed and re-clustered.
+    """
+    def __init__(self, Data_path, Mag, extd, manifest_dir='./manifest/', engine='sklearn'):
+        self.Data_path = Data_path
+        self.Mag = Mag
+        self.extd = extd
+        self.engine = engine
+        self.path = None
+        self.dirty = False
+        self.saved = time.monotonic()
+        if manifest_dir is not None:
+            key = hashlib.md5(repr((os.path.abspath(Data_path), Mag, extd)).encode()).hexdigest()[:16]
+            self.path = os.path.join(manifest_dir, f'{Mag}X_e{extd}_{engine}_{key}.pkl')
+        self.ptids = {}
+        self.slides = {}
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    state = pickle.load(f)
+                if state['version'] == MANIFEST_VERSION:
+                    self.ptids = state['ptids']
+                    self.slides = state['slides']
+            except Exception:
+                pass
+
+    @classmethod
+    def open(cls, Data_path, Mag, extd, manifest_dir='./manifest/', engine='sklearn'):
+        key = (os.path.abspath(Data_path), Mag, extd, manifest_dir, engine)
+        if key not in _MANIFESTS:
+            _MANIFESTS[key] = cls(Data_path, Mag, extd, manifest_dir, engine)
+            atexit.register(_MANIFESTS[key].save)
+        return _MANIFESTS[key]
+
+    def listdir(self, ptid):
+        mtime = dir_mtime(os.path.join(self.Data_path, ptid))
+        cached = self.ptids.get(ptid)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        slides = os.listdir(os.path.join(self.Data_path, ptid))
+        self.ptids[ptid] = (mtime, slides)
+        self.dirty = True
+        return slides
+
+    def get(self, ptid, slide):
+        entry = self.slides.get((ptid, slide))
+        if entry is None:
+            return None
+        mtime = (dir_mtime(os.path.join(self.Data_path, ptid, slide, self.Mag)),
+                 dir_mtime(os.path.join(self.Data_path, ptid, slide, self.Mag.split('_')[0])))
+        if entry['mtime'] != mtime:
+            return None
+        return entry
+
+    def add(self, ptid, slide, entry):
+        self.slides[(ptid, slide)] = entry
+        self.dirty = True
+        return entry
+
+    def build(self, ptid, slide):
+        return self.add(ptid, slide, index_slide(self.Data_path, ptid, slide, self.Mag, self.extd, self.engine))
+
+    def set_label(self, entry, label):
+        if entry['label'] != label:
+            entry['label'] = label
+            self.dirty = True
+        return entry
+
+    def entry(self, ptid, slide, label):
+        # The slide's entry, and whether it had to be (re)built.
+        entry = self.get(ptid, slide)
+        built = entry is None
+        if built:
+            entry = self.build(ptid, slide)
+        return self.set_label(entry, label), built
+
+    def save(self, interval=0):
+        # Every rank indexes the same slides; rank 0 writes for all of them.
+        if self.path is None or not self.dirty or time.monotonic() - self.saved < interval:
+            return
+        dist = sys.modules.get('torch.distributed')
+        if dist is not None and dist.is_available() and dist.is_initialized() and dist.get_rank() != 0:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': MANIFEST_VERSION,
+                         'ptids': self.ptids,
+                         'slides': self.slides}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self.dirty = False
+        self.saved = time.monotonic()
+
+
+def _index_job(job):
+    return index_slide(*job)
+
+
+def map_slides(jobs, workers=1):
+    # Results come back in job order whatever the worker count, so global
+    # patch indices assigned afterwards are deterministic.
+    if workers <= 1 or len(jobs) <= 1:
+        return list(map(_index_job, jobs))
+    workers = min(workers, len(jobs))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_index_job, jobs, chunksize=max(1, len(jobs)//(4*workers))))
+
+
+def index_slides(Data_path, ptids, Mag, extd, data_map, limit=1, manifest_dir='./manifest/', engine='sklearn', workers=1):
+    manifest = SlideManifest.open(Data_path, Mag, extd, manifest_dir, engine)
+    candidates = [
+        (ptid, slide, manifest.get(ptid, slide))
+        for ptid in ptids
+        for slide in manifest.listdir(ptid)
+    ]
+    built = iter(map_slides([
+        (Data_path, ptid, slide, Mag, extd, engine)
+        for ptid, slide, entry in candidates
+        if entry is None
+    ], workers))
+
+    slides = []
+    for ptid, slide, entry in candidates:
+        if entry is None:
+            entry = manifest.add(ptid, slide, next(built))
+        if limit > len(entry['names_t']):
+            continue
+        slides.append((ptid, slide, manifest.set_label(entry, data_map[ptid]['patient-label'])))
+    manifest.save()
+    return slides
+
+
+def index_slide_cached(Data_path, ptid, slide, Mag, extd, data_map, manifest_dir='./manifest/', engine='sklearn'):
+    # Called once per slide by the hotmap and CAM scripts. The manifest is
+    # opened once per process and rewritten only after a slide was built,
+    # at most every SAVE_INTERVAL seconds; the rest is written at exit.
+    manifest = SlideManifest.open(Data_path, Mag, extd, manifest_dir, engine)
+    entry, built = manifest.entry(ptid, slide, data_map[ptid]['patient-label'])
+    if built:
+        manifest.save(SAVE_INTERVAL)
+    return [(ptid, slide, entry)]
+
+
+class PathTable(object):
+    """Tile paths as a directory prefix table plus packed basenames."""
+    def __init__(self, prefixes, dir_id, names):
+        self.prefixes = prefixes
+        self.dir_id = dir_id
+        self.names = names
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        return os.path.join(self.prefixes[self.dir_id[index]], self.names[index].decode('utf-8'))
+
+
+class SlideLabels(object):
+    """Per-tile labels stored once per slide."""
+    def __init__(self, offsets, labels):
+        self.offsets = offsets
+        self.labels = labels
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.labels[np.searchsorted(self.offsets, index, side='right')-1].item()
+
+
+class ClusterIndex(object):
+    """CSR cluster table: slide i owns rows offsets[i]:offsets[i+1] of the
+    flat int32 array viewed as (n_clusters, extd+1) global patch indices."""
+    def __init__(self, keys, offsets, flat, width):
+        self.slide_id = {key: i for i, key in enumerate(keys)}
+        self.offsets = offsets
+        self.flat = flat
+        self.width = width
+
+    def __len__(self):
+        return len(self.slide_id)
+
+    def __contains__(self, key):
+        return tuple(key) in self.slide_id
+
+    def __getitem__(self, key):
+        i = self.slide_id[tuple(key)]
+        return self.flat[self.offsets[i]*self.width:self.offsets[i+1]*self.width].reshape(-1, self.width)
+
+    def keys(self):
+        return self.slide_id.keys()
+
+    def sample(self, keys, padding, rng):
+        # One bag of `padding` clusters per slide, flattened to a
+        # (len(keys), padding*width) array. Slides with more clusters draw
+        # without replacement; smaller ones take every cluster padding//n
+        # times plus distinct extras, as resampling() did.
+        sid = np.array([self.slide_id[tuple(k)] for k in keys], dtype=np.int64)
+        start = self.offsets[sid]
+        n = self.offsets[sid + 1] - start
+        fill = np.where(n > padding, 0, padding // np.maximum(n, 1) * n)
+        m = padding - fill
+        # Floyd's algorithm, vectorized over bags: m distinct draws from n.
+        pick = np.zeros((len(sid), padding), dtype=np.int64)
+        for step in range(padding):
+            j = n - m + step
+            t = (rng.random(len(sid)) * (j + 1)).astype(np.int64)
+            pick[:, step] = np.where((pick[:, :step] == t[:, None]).any(1), j, t)
+        k = np.arange(padding)
+        extra = np.take_along_axis(pick, np.maximum(k - fill[:, None], 0), 1)
+        pos = np.where(k < fill[:, None], k % np.maximum(n, 1)[:, None], extra)
+        return self.flat.reshape(-1, self.width)[start[:, None] + pos].reshape(len(sid), -1)
+
+
+def balance_shards(costs, num_shards):
+    # Longest-processing-time first: each slide, heaviest first, goes to the
+    # least loaded shard (lowest shard on ties), so every rank computes the
+    # same split. Shards list their slide positions in ascending order.
+    load = [(0, r) for r in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for i in np.argsort(-np.asarray(costs, dtype=np.float64), kind='stable'):
+        cost, r = heapq.heappop(load)
+        shards[r].append(i)
+        heapq.heappush(load, (cost + costs[i], r))
+    return [np.sort(np.array(s, dtype=np.int64)) for s in shards]
+
+
+def compact_index(slides):
+    prefixes = {}
+    dir_id, names, tile_off, labels, rows, row_off = [], [], [0], [], [], [0]
+    index = 0
+    for ptid, slide, entry in slides:
+        for d, n in ((entry['dir_t'], entry['names_t']), (entry['dir_a'], entry['names_a'])):
+            dir_id.append(np.full(len(n), prefixes.setdefault(d, len(prefixes)), dtype=np.int32))
+            names.append(n)
+        rows.append(entry['cluster'] + index)
+        index += len(entry['names_t']) + len(entry['names_a'])
+        tile_off.append(index)
+        row_off.append(row_off[-1] + len(entry['cluster']))
+        labels.append(entry['label'])
+    if index >= 2**31:
+        raise ValueError(f'{index} tiles do not fit in int32 patch indices')
+
+    width = slides[0][2]['cluster'].shape[1] if slides else 1
+    patch = PathTable(
+        [d for d, _ in sorted(prefixes.items(), key=lambda x: x[1])],
+        np.concatenate(dir_id) if dir_id else np.zeros(0, dtype=np.int32),
+        np.concatenate(names) if names else np.zeros(0, dtype='S1'),
+    )
+    label = SlideLabels(np.array(tile_off, dtype=np.int64), np.array(labels))
+    indices = ClusterIndex(
+        [(ptid, slide) for ptid, slide, _ in slides],
+        np.array(row_off, dtype=np.int64),
+        np.concatenate(rows).astype(np.int32).ravel() if rows else np.zeros(0, dtype=np.int32),
+        width,
+    )
+    return patch, label, indices
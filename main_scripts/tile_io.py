@@ -0,0 +1,290 @@
+from __future__ import print_function
+import numpy as np
+import os
+import io
+import copy
+import math
+import mmap
+import hashlib
+from collections import OrderedDict
+from PIL import Image
+from torchvision import transforms as T
+from slide_index import get_loc, pack_names, dir_mtime
+
+
+SHARD_SUFFIX = '.shard'
+SHARD_MAGIC = b'MILSHRD1'
+
+
+def pack_dir(src_dir, dst_prefix):
+    # One shard per tile directory: the encoded tile bytes back to back, then
+    # an npz index of sorted basenames, byte offsets, grid coordinates and the
+    # directory mtime, then the index offset and SHARD_MAGIC. Tiles and index
+    # are one file, so the rename publishes both at once.
+    mtime = dir_mtime(src_dir)
+    names = np.sort(pack_names([n for n in os.listdir(src_dir) if not n.startswith('.')]))
+    offsets = np.zeros(len(names)+1, dtype=np.int64)
+    loc = np.zeros((len(names), 2), dtype=np.int32)
+    os.makedirs(os.path.dirname(dst_prefix), exist_ok=True)
+    tmp = f'{dst_prefix}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        for i, name in enumerate(names):
+            name = name.decode('utf-8')
+            with open(os.path.join(src_dir, name), 'rb') as g:
+                data = g.read()
+            f.write(data)
+            offsets[i+1] = offsets[i] + len(data)
+            try:
+                loc[i] = get_loc(name)[:2]
+            except ValueError:
+                loc[i] = -1
+        start = f.tell()
+        np.savez(f, names=names, offsets=offsets, loc=loc, mtime=np.int64(mtime or 0))
+        f.write(np.int64(start).tobytes() + SHARD_MAGIC)
+    os.replace(tmp, dst_prefix + SHARD_SUFFIX)
+    return len(names)
+
+
+def read_index(f):
+    # Index of an open shard file, or None if it is not a complete shard.
+    size = f.seek(0, os.SEEK_END)
+    if size < 16:
+        return None
+    f.seek(size - 16)
+    trailer = f.read(16)
+    if trailer[8:] != SHARD_MAGIC:
+        return None
+    start = int(np.frombuffer(trailer[:8], dtype=np.int64)[0])
+    f.seek(start)
+    with np.load(io.BytesIO(f.read(size - 16 - start))) as index:
+        return {k: index[k] for k in index.files}
+
+
+def index_is_current(index, src_dir):
+    return index is not None and int(index['mtime']) == (dir_mtime(src_dir) or 0)
+
+
+def shard_is_current(src_dir, dst_prefix):
+    try:
+        with open(dst_prefix + SHARD_SUFFIX, 'rb') as f:
+            return index_is_current(read_index(f), src_dir)
+    except FileNotFoundError:
+        return False
+
+
+class FileReader(object):
+    def open(self, path):
+        return Image.open(path)
+
+
+class ShardReader(object):
+    """Reads tiles out of packed shards by memory-mapping each shard.
+
+    Paths are resolved relative to data_root, so the dataset keeps passing
+    ordinary tile paths. Tiles whose shard is missing, or was packed before
+    its directory last changed (re-tiled or rewritten), fall back to the file.
+    """
+    def __init__(self, data_root, shard_root, max_open=64):
+        self.data_root = os.path.abspath(data_root)
+        self.shard_root = shard_root
+        self.max_open = max_open
+        self.shards = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = OrderedDict()
+        return state
+
+    def shard(self, dirname):
+        if dirname in self.shards:
+            self.shards.move_to_end(dirname)
+            return self.shards[dirname]
+        prefix = os.path.join(self.shard_root, os.path.relpath(os.path.abspath(dirname), self.data_root))
+        shard = None
+        try:
+            with open(prefix + SHARD_SUFFIX, 'rb') as f:
+                index = read_index(f)
+                if index_is_current(index, dirname):
+                    shard = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), index['names'], index['offsets'])
+        except FileNotFoundError:
+            pass
+        self.shards[dirname] = shard
+        if len(self.shards) > self.max_open:
+            _, old = self.shards.popitem(last=False)
+            if old is not None:
+                old[0].close()
+        return shard
+
+    def read(self, path):
+        dirname, name = os.path.split(path)
+        shard = self.shard(dirname)
+        if shard is None:
+            return None
+        buf, names, offsets = shard
+        key = name.encode('utf-8')
+        i = np.searchsorted(names, key)
+        if i >= len(names) or names[i] != key:
+            return None
+        return buf[offsets[i]:offsets[i+1]]
+
+    def open(self, path):
+        data = self.read(path)
+        if data is None:
+            return Image.open(path)
+        return Image.open(io.BytesIO(data))
+
+
+DRAFT_SCALES = (1. / 8, 1. / 4, 1. / 2, 1.)
+
+
+class DraftDecode(object):
+    """Runs `transform` on a JPEG decoded at 1/2, 1/4 or 1/8 scale (PIL draft
+    mode) when its first Resize would discard that resolution anyway.
+
+    With tolerance > 1 a scale is also accepted if the Resize then upsamples
+    by at most that factor. A CenterCrop/RandomCrop before the Resize is
+    rescaled to the decoded size; everything after it is unchanged.
+    """
+    def __init__(self, transform, tolerance=1.0):
+        self.transform = transform
+        self.transforms = [transform]
+        self.tolerance = tolerance
+        self.ops = list(transform.transforms) if hasattr(transform, 'transforms') else [transform]
+        self.crop = self.resize = None
+        for k, op in enumerate(self.ops):
+            name = type(op).__name__
+            if name in ('CenterCrop', 'RandomCrop') and self.crop is None and not getattr(op, 'padding', None):
+                self.crop = k
+                continue
+            if name == 'Resize':
+                self.resize = k
+            break
+        self.scaled = {1.: transform}
+
+    def __repr__(self):
+        return '{}(tolerance={}, {!r})'.format(self.__class__.__name__, self.tolerance, self.transform)
+
+    def scale(self, size):
+        if self.resize is None:
+            return 1.
+        w, h = size
+        if self.crop is not None:
+            h, w = self.ops[self.crop].size
+        target = self.ops[self.resize].size
+        if isinstance(target, int) or len(target) == 1:
+            need = (target if isinstance(target, int) else target[0]) / min(w, h)
+        else:
+            need = max(target[0] / h, target[1] / w)
+        return next(s for s in DRAFT_SCALES if s * self.tolerance >= need or s == 1.)
+
+    def transform_for(self, s):
+        if s not in self.scaled:
+            ops = list(self.ops)
+            if self.crop is not None:
+                ops[self.crop] = copy.copy(ops[self.crop])
+                ops[self.crop].size = tuple(int(round(c * s)) for c in ops[self.crop].size)
+            self.scaled[s] = T.Compose(ops)
+        return self.scaled[s]
+
+    def __call__(self, img):
+        s = getattr(img, 'draft_scale', None)
+        if s is None:
+            s = 1.
+            target = self.scale(img.size) if img.format == 'JPEG' else 1.
+            if target < 1.:
+                w, h = img.size
+                img.draft('RGB', (int(math.ceil(w * target)), int(math.ceil(h * target))))
+                s = img.size[0] / w
+            # Tiles shared by several cluster slots are transformed again
+            # from the same decoded image.
+            img.draft_scale = s
+        return self.transform_for(s)(img)
+
+
+DETERMINISTIC_TRANSFORMS = ('CenterCrop', 'Resize', 'Pad', 'Grayscale', 'ToTensor', 'PILToTensor', 'ConvertImageDtype', 'Normalize')
+
+
+def is_deterministic(transform):
+    if transform is None:
+        return True
+    if hasattr(transform, 'transforms'):
+        return all(is_deterministic(t) for t in transform.transforms)
+    return type(transform).__name__ in DETERMINISTIC_TRANSFORMS
+
+
+def transform_key(transform, data_root, Mag):
+    spec = '|'.join([repr(transform), os.path.abspath(data_root), Mag])
+    return hashlib.md5(spec.encode('utf-8')).hexdigest()[:16]
+
+
+def create_once(tmp, path):
+    # Moves the finished file tmp to path unless path exists. Ranks and
+    # loader workers race here; an array another one created, and may be
+    # filling already, is never replaced.
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp)
+
+
+class TileCache(object):
+    """Transformed uint8 tiles in one memory-mapped (n, h, w, 3) array per slide.
+
+    A row is decoded and transformed on its first read and flagged in a
+    companion mask, so later runs with the same transform read pixels
+    straight from the page cache. Arrays are named after the slide's
+    directory mtimes, so re-tiled slides get a fresh array.
+    """
+    def __init__(self, cache_dir, transform, data_root, Mag, slides, offsets, shape):
+        if not is_deterministic(transform):
+            raise ValueError('only deterministic transforms can be cached: {!r}'.format(transform))
+        root = os.path.join(cache_dir, transform_key(transform, data_root, Mag))
+        self.transform = transform
+        self.offsets = offsets
+        self.shape = tuple(shape)
+        self.prefixes = []
+        for i, (ptid, slide, entry) in enumerate(slides):
+            prefix = os.path.join(root, ptid, slide, '_'.join(str(t or 0) for t in entry['mtime']))
+            n = int(offsets[i+1] - offsets[i])
+            if not os.path.exists(prefix + '.mask.npy'):
+                os.makedirs(os.path.dirname(prefix), exist_ok=True)
+                tmp = f'{prefix}.{os.getpid()}.tmp'
+                np.lib.format.open_memmap(tmp + '.npy', mode='w+', dtype=np.uint8, shape=(n,) + self.shape).flush()
+                create_once(tmp + '.npy', prefix + '.npy')
+                np.save(tmp + '.mask.npy', np.zeros(n, dtype=np.uint8))
+                create_once(tmp + '.mask.npy', prefix + '.mask.npy')
+            self.prefixes.append(prefix)
+        self.arrays = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = {}
+        return state
+
+    def slide(self, i):
+        if i not in self.arrays:
+            self.arrays[i] = (
+                np.load(self.prefixes[i] + '.npy', mmap_mode='r+'),
+                np.load(self.prefixes[i] + '.mask.npy', mmap_mode='r+'),
+            )
+        return self.arrays[i]
+
+    def get(self, index, path, reader):
+        i = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        pixels, mask = self.slide(i)
+        row = index - int(self.offsets[i])
+        if not mask[row]:
+            img = np.asarray(self.transform(reader.open(path)), dtype=np.uint8)
+            if img.shape != self.shape:
+                return img
+            pixels[row] = img
+            mask[row] = 1
+        return pixels[row]
+
+
+def get_reader(data_root, shard_root=None):
+    if shard_root:
+        return ShardReader(data_root, shard_root)
+    return FileReader()